@@ -1,13 +1,42 @@
 import os
+import re
+import mimetypes
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager
+from flask_caching import Cache
+from flask_compress import Compress
+from werkzeug.utils import import_string
 from config import config
 
 # Initialize extensions
 db = SQLAlchemy()
 jwt = JWTManager()
+cache = Cache()
+compress = Compress()
+
+# Allowed CORS origins, matched with one compiled regex instead of a list scan
+CORS_ORIGINS = re.compile(
+    r'^(https://(www\.|app\.)?penlog\.io'
+    r'|http://localhost:(3000|3001)'
+    r'|https://6955e3e4--penlog-landing\.netlify\.app)$'
+)
+
+# (import path, url prefix) for every API blueprint
+BLUEPRINTS = [
+    ('routes.auth:auth_bp', '/api/auth'),
+    ('routes.projects:projects_bp', '/api/projects'),
+    ('routes.penetrations:penetrations_bp', '/api/penetrations'),
+    ('routes.contractors:contractors_bp', '/api/contractors'),
+    ('routes.photos:photos_bp', '/api/photos'),
+    ('routes.dashboard:dashboard_bp', '/api/dashboard'),
+    ('routes.registration:registration_bp', '/api/registration'),
+    ('routes.report:report_bp', '/api/report'),
+    ('routes.pdf:pdf_bp', '/api/pdf'),
+    ('routes.access:access_bp', '/api/access'),
+    ('routes.admin:admin_bp', '/api/admin'),
+]
 
 def create_app(config_name=None):
     """Application factory pattern"""
@@ -17,69 +46,65 @@ def create_app(config_name=None):
     app = Flask(__name__)
     app.config.from_object(config[config_name])
     
+    # Encode jsonify() responses with orjson
+    from utils.responses import ORJSONProvider
+    app.json = ORJSONProvider(app)
+    
     # Disable strict slashes to prevent 308 redirects
     app.url_map.strict_slashes = False
     
     # Initialize extensions with app
     db.init_app(app)
     jwt.init_app(app)
+    cache.init_app(app)
+    compress.init_app(app)
     
     # Configure CORS
     CORS(app, resources={
         r"/api/*": {
-            "origins": [
-                "http://localhost:3000", 
-                "http://localhost:3001", 
-                "https://penlog.io",
-                "https://www.penlog.io",
-                "https://app.penlog.io",
-                "https://6955e3e4--penlog-landing.netlify.app"
-            ],
+            "origins": CORS_ORIGINS,
             "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
             "allow_headers": ["Content-Type", "Authorization"],
             "supports_credentials": True
         }
     })
     
-    # Ensure upload folder exists
+    # Ensure upload folder exists (exist_ok avoids a stat and the race between workers)
     upload_folder = app.config['UPLOAD_FOLDER']
-    if not os.path.exists(upload_folder):
-        os.makedirs(upload_folder)
+    os.makedirs(upload_folder, exist_ok=True)
+    if not os.access(upload_folder, os.W_OK):
+        raise RuntimeError(f'Upload folder {upload_folder!r} is not writable')
     
     # Serve uploaded files
     @app.route('/uploads/<path:filename>')
     def uploaded_file(filename):
-        from flask import send_from_directory
-        return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
-    
-    # Register blueprints
-    from routes.auth import auth_bp
-    from routes.projects import projects_bp
-    from routes.penetrations import penetrations_bp
-    from routes.contractors import contractors_bp
-    from routes.photos import photos_bp
-    from routes.dashboard import dashboard_bp
-    from routes.registration import registration_bp
-    from routes.report import report_bp
-    from routes.pdf import pdf_bp
-    from routes.access import access_bp
-    from routes.admin import admin_bp  # MOVE IT HERE!
+        from flask import send_from_directory, abort
+        from werkzeug.security import safe_join
+        accel_prefix = app.config['UPLOADS_ACCEL_REDIRECT']
+        if accel_prefix:
+            # Hand the transfer to nginx (internal location aliased to UPLOAD_FOLDER),
+            # which sendfile()s it and handles Range/ETag without a Python copy
+            location = safe_join(accel_prefix, filename)
+            if location is None:
+                abort(404)
+            mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            response = app.response_class(mimetype=mimetype)
+            response.headers['X-Accel-Redirect'] = location
+        else:
+            # Uploaded files are never rewritten, so let browsers/CDNs keep them and revalidate via 304
+            response = send_from_directory(app.config['UPLOAD_FOLDER'], filename,
+                                           max_age=31536000, conditional=True)
+        response.headers['Cache-Control'] = 'public, immutable, max-age=31536000'
+        return response
     
-    app.register_blueprint(auth_bp, url_prefix='/api/auth')
-    app.register_blueprint(projects_bp, url_prefix='/api/projects')
-    app.register_blueprint(penetrations_bp, url_prefix='/api/penetrations')
-    app.register_blueprint(contractors_bp, url_prefix='/api/contractors')
-    app.register_blueprint(photos_bp, url_prefix='/api/photos')
-    app.register_blueprint(dashboard_bp, url_prefix='/api/dashboard')
-    app.register_blueprint(registration_bp, url_prefix='/api/registration')
-    app.register_blueprint(report_bp, url_prefix='/api/report')
-    app.register_blueprint(pdf_bp, url_prefix='/api/pdf')
-    app.register_blueprint(access_bp, url_prefix='/api/access')
-    app.register_blueprint(admin_bp, url_prefix='/api/admin')
+    # Register blueprints (imported here to avoid circular imports with models)
+    for import_path, url_prefix in BLUEPRINTS:
+        app.register_blueprint(import_string(import_path), url_prefix=url_prefix)
     
     # Health check endpoint
     @app.route('/health')
     def health_check():
-        return {'status': 'healthy', 'service': 'PenLog API'}, 200
+        from services.uploads import upload_stats
+        return {'status': 'healthy', 'service': 'PenLog API', 'uploads': upload_stats()}, 200
     
     return app
\ No newline at end of file
@@ -1,40 +1,111 @@
 import os
+import re
+import tempfile
 from datetime import timedelta
 
+def _normalize_db_url(url):
+    """
+    Point Heroku-style postgres:// and bare postgresql:// URLs at psycopg2
+    
+    Newer SQLAlchemy releases default postgresql:// to psycopg 3, but psycopg2
+    is the driver this app ships with and tunes below.
+    """
+    for scheme in ('postgres://', 'postgresql://'):
+        if url and url.startswith(scheme):
+            return url.replace(scheme, 'postgresql+psycopg2://', 1)
+    return url
+
+# Set by gunicorn.conf.py; a plain `flask run` is one process
+_WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 1))
+_GUNICORN_THREADS = int(os.environ.get('GUNICORN_THREADS', 8))
+
 class Config:
     """Base configuration"""
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev-secret-key-change-in-production'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Per-process thread pools (services.background and services.uploads); see
+    # services/uploads.py for why uploads stay below the gunicorn thread count
+    BACKGROUND_THREADS = 4
+    UPLOAD_CONCURRENCY_LIMIT = int(os.environ.get('UPLOAD_CONCURRENCY_LIMIT', max(1, _GUNICORN_THREADS // 2)))
+    # The pool is per worker process: one connection per gunicorn thread, plus
+    # overflow for every background thread (export jobs hold theirs for the whole
+    # file build). When running behind PgBouncer in transaction mode, keep
+    # DB_POOL_SIZE small per worker and let PgBouncer multiplex connections
+    # across dynos.
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', _GUNICORN_THREADS)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', BACKGROUND_THREADS + UPLOAD_CONCURRENCY_LIMIT)),
+        'pool_pre_ping': True,  # Drop dead connections instead of returning 500s
+        'pool_recycle': 300,
+        'pool_use_lifo': True,  # Keep a hot subset of connections warm
+        'connect_args': {'options': '-c statement_timeout=30000'},
+        # Send executemany() UPDATE/DELETE batches (e.g. ORM flushes of many rows)
+        # in pages via execute_batch instead of one round-trip per row
+        'executemany_mode': 'values_plus_batch'
+    }
+    # Redis shares cached responses (and invalidations) across gunicorn workers.
+    # SimpleCache is per-process, so a write on one worker would leave the others
+    # serving stale responses: without REDIS_URL, several workers run uncached.
+    if os.environ.get('REDIS_URL'):
+        CACHE_TYPE = 'RedisCache'
+    elif _WEB_CONCURRENCY > 1:
+        CACHE_TYPE = 'NullCache'
+    else:
+        CACHE_TYPE = 'SimpleCache'
+    CACHE_REDIS_URL = os.environ.get('REDIS_URL')
+    CACHE_DEFAULT_TIMEOUT = 30
+    # Brotli (falling back to gzip) for JSON bodies of 2KB and up; smaller
+    # payloads fit in a packet or two and aren't worth the CPU
+    COMPRESS_ALGORITHM = ['br', 'gzip']
+    COMPRESS_MIN_SIZE = 2048
+    COMPRESS_MIMETYPES = ['application/json']
     JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY') or 'jwt-secret-key-change-in-production'
+    # Symmetric HMAC signing keeps per-request verification to a few microseconds;
+    # JWT_SECRET_KEY should be at least 32 random bytes in production
+    JWT_ALGORITHM = 'HS256'
     JWT_ACCESS_TOKEN_EXPIRES = timedelta(hours=24)
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file upload
     UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER') or 'uploads'
-    ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+    # Background export files and staged uploads. Kept outside UPLOAD_FOLDER, which
+    # /uploads/<path> serves publicly and without auth.
+    WORK_FOLDER = os.environ.get('WORK_FOLDER') or os.path.join(tempfile.gettempdir(), 'penlog')
+    # Behind nginx, set to an internal location aliasing UPLOAD_FOLDER (e.g.
+    # '/protected/' with 'internal; alias /var/uploads/; sendfile on;') to serve
+    # /uploads/ via X-Accel-Redirect instead of streaming files through Python
+    UPLOADS_ACCEL_REDIRECT = os.environ.get('UPLOADS_ACCEL_REDIRECT')
+    ALLOWED_EXTENSIONS = frozenset({'png', 'jpg', 'jpeg', 'gif', 'heic'})
+    ALLOWED_EXTENSION_RE = re.compile(r'\.(png|jpe?g|gif|heic)$', re.IGNORECASE)
+    
+    @staticmethod
+    def is_allowed(filename):
+        """Check an upload's extension with one regex match (no split/lower copies)"""
+        return Config.ALLOWED_EXTENSION_RE.search(filename) is not None
 
 class DevelopmentConfig(Config):
     """Development configuration"""
     DEBUG = True
-    database_url = os.environ.get('DATABASE_URL') or \
-        os.environ.get('DEV_DATABASE_URL') or \
+    SQLALCHEMY_DATABASE_URI = _normalize_db_url(
+        os.environ.get('DATABASE_URL') or
+        os.environ.get('DEV_DATABASE_URL') or
         'postgresql://localhost/penlog_dev'
-    if database_url and database_url.startswith('postgres://'):
-        database_url = database_url.replace('postgres://', 'postgresql://', 1)
-    SQLALCHEMY_DATABASE_URI = database_url
-    SQLALCHEMY_ECHO = True
+    )
+    # Statement logging is expensive; opt in with SQLALCHEMY_ECHO=1 when debugging
+    SQLALCHEMY_ECHO = os.environ.get('SQLALCHEMY_ECHO', '0') == '1'
 
 class ProductionConfig(Config):
     """Production configuration"""
     DEBUG = False
-    database_url = os.environ.get('DATABASE_URL')
-    # Heroku uses postgres:// but SQLAlchemy needs postgresql://
-    if database_url and database_url.startswith('postgres://'):
-        database_url = database_url.replace('postgres://', 'postgresql://', 1)
-    SQLALCHEMY_DATABASE_URI = database_url
+    SQLALCHEMY_DATABASE_URI = _normalize_db_url(os.environ.get('DATABASE_URL'))
+    # Heroku Postgres requires TLS; pin it rather than negotiating per connection
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        **Config.SQLALCHEMY_ENGINE_OPTIONS,
+        'connect_args': {**Config.SQLALCHEMY_ENGINE_OPTIONS['connect_args'], 'sslmode': 'require'}
+    }
 
 class TestingConfig(Config):
     """Testing configuration"""
     TESTING = True
-    SQLALCHEMY_DATABASE_URI = 'postgresql://localhost/penlog_test'
+    SQLALCHEMY_DATABASE_URI = _normalize_db_url('postgresql://localhost/penlog_test')
 
 config = {
     'development': DevelopmentConfig,
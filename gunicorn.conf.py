@@ -0,0 +1,17 @@
+"""Gunicorn settings (loaded automatically from the working directory)"""
+import multiprocessing
+import os
+
+# Requests spend most of their time waiting on Postgres/Cloudinary, so run threaded
+# workers: each worker serves `threads` requests concurrently. DB_POOL_SIZE
+# defaults to the thread count so every thread can hold a connection; keep
+# UPLOAD_CONCURRENCY_LIMIT below the thread count (it defaults to half) so
+# uploads can't take every thread.
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+keepalive = 5
+
+# config.py reads these to pick a cache backend and size the DB pool per worker
+os.environ['WEB_CONCURRENCY'] = str(workers)
+os.environ['GUNICORN_THREADS'] = str(threads)
@@ -0,0 +1,24 @@
+"""Add partial unique index allowing one pending access request per email"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db
+from sqlalchemy import text
+
+app = create_app()
+
+with app.app_context():
+    # Fails if duplicate pending requests already exist - resolve those first with:
+    #   SELECT email, COUNT(*) FROM access_requests WHERE status = 'pending' GROUP BY email HAVING COUNT(*) > 1
+    try:
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.execute(text("""
+                CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ux_access_requests_pending_email
+                ON access_requests (email)
+                WHERE status = 'pending'
+            """))
+        print("✅ Successfully added ux_access_requests_pending_email index")
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        raise
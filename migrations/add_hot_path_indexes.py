@@ -0,0 +1,38 @@
+"""Add composite indexes for hot query predicates"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db
+from sqlalchemy import text
+
+INDEXES = [
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_access_requests_email ON access_requests (email)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_access_requests_status_created ON access_requests (status, created_at)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_access_requests_pending_created ON access_requests (created_at DESC) WHERE status = 'pending'",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_penetrations_project_status ON penetrations (project_id, status)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_penetrations_contractor_status ON penetrations (contractor_id, status)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_penetrations_deck_status ON penetrations (deck, status)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_penetrations_priority_status ON penetrations (priority, status)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_penetrations_project_pen_id ON penetrations (project_id, pen_id)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_photos_penetration_uploaded ON photos (penetration_id, uploaded_at)",
+    # Superseded by ix_photos_penetration_uploaded (same leading column)
+    "DROP INDEX CONCURRENTLY IF EXISTS ix_photos_penetration_id",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_pen_activities_pen_ts ON pen_activities (penetration_id, timestamp)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_pen_activities_status_pen_ts ON pen_activities (new_status, penetration_id, timestamp)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_pen_activities_ts ON pen_activities (timestamp)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_contractor_access_tokens_active_project ON contractor_access_tokens (project_id, contractor_id) WHERE active",
+]
+
+app = create_app()
+
+with app.app_context():
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction block
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        for statement in INDEXES:
+            try:
+                conn.execute(text(statement))
+                print(f"✅ {statement}")
+            except Exception as e:
+                print(f"❌ Error: {e}")
+                raise
@@ -0,0 +1,35 @@
+"""Add content_hash to photos for duplicate upload detection"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db
+from sqlalchemy import text
+
+app = create_app()
+
+with app.app_context():
+    # Nullable with no default: existing photos simply never match as duplicates
+    try:
+        with db.engine.connect() as conn:
+            conn.execute(text("""
+                ALTER TABLE photos
+                ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64)
+            """))
+            conn.commit()
+        print("✅ Successfully added content_hash column to photos table")
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        raise
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction block
+    try:
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.execute(text("""
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_photos_penetration_hash
+                ON photos (penetration_id, content_hash)
+            """))
+        print("✅ Successfully added ix_photos_penetration_hash index")
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        raise
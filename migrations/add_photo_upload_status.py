@@ -0,0 +1,23 @@
+"""Add upload_status to photos for background (?async=true) uploads"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db
+from sqlalchemy import text
+
+app = create_app()
+
+with app.app_context():
+    # Existing photos are all on Cloudinary already, so the default covers them
+    try:
+        with db.engine.connect() as conn:
+            conn.execute(text("""
+                ALTER TABLE photos
+                ADD COLUMN IF NOT EXISTS upload_status VARCHAR(20) NOT NULL DEFAULT 'uploaded'
+            """))
+            conn.commit()
+        print("✅ Successfully added upload_status column to photos table")
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        raise
@@ -0,0 +1,43 @@
+"""Move timestamp defaults from Python to the database"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db
+from sqlalchemy import text
+
+# (table, column) pairs that previously defaulted to datetime.utcnow
+COLUMNS = [
+    ('project_contractors', 'added_at'),
+    ('projects', 'created_at'),
+    ('projects', 'updated_at'),
+    ('users', 'created_at'),
+    ('contractors', 'created_at'),
+    ('penetrations', 'created_at'),
+    ('penetrations', 'updated_at'),
+    ('pen_activities', 'timestamp'),
+    ('photos', 'uploaded_at'),
+    ('contractor_registrations', 'created_at'),
+    ('contractor_access_tokens', 'created_at'),
+    ('access_requests', 'created_at'),
+]
+
+app = create_app()
+
+with app.app_context():
+    # Backfill NULLs first so SET NOT NULL succeeds; all-or-nothing in one transaction
+    try:
+        with db.engine.begin() as conn:
+            for table, column in COLUMNS:
+                conn.execute(text(
+                    f'UPDATE {table} SET "{column}" = timezone(\'utc\', now()) WHERE "{column}" IS NULL'
+                ))
+                conn.execute(text(
+                    f'ALTER TABLE {table} ALTER COLUMN "{column}" SET DEFAULT timezone(\'utc\', now()), '
+                    f'ALTER COLUMN "{column}" SET NOT NULL'
+                ))
+                print(f"✅ {table}.{column}")
+        print("✅ Timestamp defaults moved to the database")
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        raise
@@ -1,12 +1,26 @@
 from datetime import datetime
+from sqlalchemy import func
 from app import db
-import secrets
+import base64
+import os
+
+def urlsafe_tokens(count, nbytes):
+    """Generate count URL-safe tokens (same format as secrets.token_urlsafe) from one os.urandom call"""
+    raw = os.urandom(count * nbytes)
+    return [
+        base64.urlsafe_b64encode(raw[i:i + nbytes]).rstrip(b'=').decode('ascii')
+        for i in range(0, len(raw), nbytes)
+    ]
+
+def utc_now():
+    """Server-side UTC timestamp (naive, like datetime.utcnow)"""
+    return func.timezone('utc', func.now())
 
 # Association table for many-to-many relationship between projects and contractors
 project_contractors = db.Table('project_contractors',
     db.Column('project_id', db.Integer, db.ForeignKey('projects.id'), primary_key=True),
     db.Column('contractor_id', db.Integer, db.ForeignKey('contractors.id'), primary_key=True),
-    db.Column('added_at', db.DateTime, default=datetime.utcnow)
+    db.Column('added_at', db.DateTime, nullable=False, server_default=utc_now())
 )
 
 class Project(db.Model):
@@ -22,19 +36,56 @@ class Project(db.Model):
     notes = db.Column(db.Text)
     supervisor_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     invite_code = db.Column(db.String(32), unique=True, index=True)  # ADD THIS LINE
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, server_default=utc_now())
+    updated_at = db.Column(db.DateTime, nullable=False, server_default=utc_now(), onupdate=utc_now())
     
     # Relationships
-    penetrations = db.relationship('Penetration', backref='project', lazy='dynamic', cascade='all, delete-orphan')
+    penetrations = db.relationship('Penetration', backref='project', lazy='select', cascade='all, delete-orphan')
     supervisor = db.relationship('User', backref='supervised_projects')
     
     def generate_invite_code(self):
         """Generate a unique invite code for contractor registration"""
-        self.invite_code = secrets.token_urlsafe(16)  # Generates a 16-character URL-safe code
+        self.invite_code = urlsafe_tokens(1, 16)[0]  # 16 random bytes -> 22-character URL-safe code
         return self.invite_code
     
-    def to_dict(self, include_stats=False):
+    @staticmethod
+    def penetration_stats(project_ids):
+        """Return {project_id: stats} for many projects in one grouped query"""
+        stats = {project_id: {
+            'total_penetrations': 0,
+            'not_started': 0,
+            'open': 0,
+            'closed': 0,
+            'verified': 0
+        } for project_id in project_ids}
+        
+        if not stats:
+            return stats
+        
+        rows = db.session.query(
+            Penetration.project_id,
+            func.count(Penetration.id),
+            func.count(Penetration.id).filter(Penetration.status == 'not_started'),
+            func.count(Penetration.id).filter(Penetration.status == 'open'),
+            func.count(Penetration.id).filter(Penetration.status == 'closed'),
+            func.count(Penetration.id).filter(Penetration.status == 'verified')
+        ).filter(
+            Penetration.project_id.in_(stats.keys())
+        ).group_by(Penetration.project_id).all()
+        
+        for project_id, total, not_started, open_count, closed, verified in rows:
+            stats[project_id] = {
+                'total_penetrations': total,
+                'not_started': not_started,
+                'open': open_count,
+                'closed': closed,
+                'verified': verified
+            }
+        
+        return stats
+    
+    def to_dict(self, include_stats=False, stats=None):
+        """Pass precomputed stats (see penetration_stats) when serializing many projects"""
         data = {
             'id': self.id,
             'name': self.name,
@@ -51,13 +102,9 @@ class Project(db.Model):
         }
         
         if include_stats:
-            data['stats'] = {
-                'total_penetrations': self.penetrations.count(),
-                'not_started': self.penetrations.filter_by(status='not_started').count(),
-                'open': self.penetrations.filter_by(status='open').count(),
-                'closed': self.penetrations.filter_by(status='closed').count(),
-                'verified': self.penetrations.filter_by(status='verified').count()
-            }
+            if stats is None:
+                stats = Project.penetration_stats([self.id])[self.id]
+            data['stats'] = stats
         
         return data
 
@@ -71,7 +118,7 @@ class User(db.Model):
     password_hash = db.Column(db.String(256), nullable=False)
     role = db.Column(db.String(20), nullable=False, default='contractor')  # supervisor, contractor
     contractor_id = db.Column(db.Integer, db.ForeignKey('contractors.id'), nullable=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, server_default=utc_now())
     
     contractor = db.relationship('Contractor', backref='users')
     
@@ -95,7 +142,7 @@ class Contractor(db.Model):
     contact_email = db.Column(db.String(120))
     contact_phone = db.Column(db.String(20))
     active = db.Column(db.Boolean, default=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, server_default=utc_now())
     
     def to_dict(self):
         return {
@@ -126,29 +173,58 @@ class Penetration(db.Model):
     opened_at = db.Column(db.DateTime)  # When pen was opened
     completed_at = db.Column(db.DateTime)  # When pen was closed/completed
     notes = db.Column(db.Text)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, server_default=utc_now())
+    updated_at = db.Column(db.DateTime, nullable=False, server_default=utc_now(), onupdate=utc_now())
     
     contractor = db.relationship('Contractor', backref='penetrations')
-    activities = db.relationship('PenActivity', backref='penetration', lazy='dynamic', 
+    # Plain lists: routes that serialize these use selectinload() to batch them
+    activities = db.relationship('PenActivity', backref='penetration', lazy='select',
                                 cascade='all, delete-orphan')
-    photos = db.relationship('Photo', backref='penetration', lazy='dynamic',
+    photos = db.relationship('Photo', backref='penetration', lazy='select',
                             cascade='all, delete-orphan')
     
     # Unique constraint on pen_id per project per contractor
     __table_args__ = (
         db.UniqueConstraint('project_id', 'contractor_id', 'pen_id', name='unique_pen_per_contractor'),
+        db.Index('ix_penetrations_project_status', 'project_id', 'status'),
+        db.Index('ix_penetrations_contractor_status', 'contractor_id', 'status'),
+        # Dashboard by-deck grouping and critical-status filtering
+        db.Index('ix_penetrations_deck_status', 'deck', 'status'),
+        db.Index('ix_penetrations_priority_status', 'priority', 'status'),
+        # Per-project pen ID lookups (bulk import duplicate check) regardless of contractor
+        db.Index('ix_penetrations_project_pen_id', 'project_id', 'pen_id'),
     )
     
-    def to_dict(self, include_activities=False, include_photos=False):
-    # Get photo count safely using scalar query
-        try:
-            from sqlalchemy import func, select
-            photo_count = db.session.scalar(
-                select(func.count(Photo.id)).where(Photo.penetration_id == self.id)
-            ) or 0
-        except:
-            photo_count = 0
+    @staticmethod
+    def photo_counts(penetration_ids):
+        """Return {penetration_id: photo count} for many penetrations in one query"""
+        if not penetration_ids:
+            return {}
+        
+        # Photos still uploading in the background don't count until they have a URL
+        rows = db.session.query(
+            Photo.penetration_id,
+            func.count(Photo.id)
+        ).filter(
+            Photo.penetration_id.in_(penetration_ids),
+            Photo.upload_status == 'uploaded'
+        ).group_by(Photo.penetration_id).all()
+        
+        return dict(rows)
+    
+    @staticmethod
+    def photo_count_upto(penetration_id, limit):
+        """Count a penetration's photos, stopping at limit (enough for minimum-photo checks)"""
+        capped = db.select(Photo.id).filter(
+            Photo.penetration_id == penetration_id,
+            Photo.upload_status == 'uploaded'
+        ).limit(limit).subquery()
+        return db.session.scalar(db.select(func.count()).select_from(capped))
+    
+    def to_dict(self, include_activities=False, include_photos=False, photo_count=None):
+        """Pass photo_count (see photo_counts) when serializing many penetrations"""
+        if photo_count is None:
+            photo_count = Penetration.photo_counts([self.id]).get(self.id, 0)
         
         data = {
             'id': self.id,
@@ -180,7 +256,7 @@ class Penetration(db.Model):
         
         if include_photos:
             try:
-                data['photos'] = [photo.to_dict() for photo in self.photos.all()]  # Add .all() here
+                data['photos'] = [photo.to_dict() for photo in self.photos]
             except:
                 data['photos'] = []
         
@@ -198,10 +274,48 @@ class PenActivity(db.Model):
     previous_status = db.Column(db.String(20))
     new_status = db.Column(db.String(20))
     notes = db.Column(db.Text)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    timestamp = db.Column(db.DateTime, nullable=False, server_default=utc_now())
     
     user = db.relationship('User')
     
+    __table_args__ = (
+        db.Index('ix_pen_activities_pen_ts', 'penetration_id', 'timestamp'),
+        # Latest "opened" activity per penetration (dashboard open-too-long)
+        db.Index('ix_pen_activities_status_pen_ts', 'new_status', 'penetration_id', 'timestamp'),
+        # Activity timeline / recent activity date-range scans
+        db.Index('ix_pen_activities_ts', 'timestamp'),
+    )
+    
+    @staticmethod
+    def feed_select():
+        """Core select of the to_dict() fields for read-only feeds (no ORM hydration)"""
+        return db.select(
+            PenActivity.id,
+            PenActivity.penetration_id,
+            PenActivity.user_id,
+            func.coalesce(User.username, PenActivity.contractor_name).label('username'),
+            PenActivity.action,
+            PenActivity.previous_status,
+            PenActivity.new_status,
+            PenActivity.notes,
+            PenActivity.timestamp
+        ).outerjoin(User, User.id == PenActivity.user_id)
+    
+    @staticmethod
+    def feed_dict(row):
+        """Serialize a feed_select() row the same way as to_dict()"""
+        return {
+            'id': row.id,
+            'penetration_id': row.penetration_id,
+            'user_id': row.user_id,
+            'username': row.username,
+            'action': row.action,
+            'previous_status': row.previous_status,
+            'new_status': row.new_status,
+            'notes': row.notes,
+            'timestamp': row.timestamp.isoformat() if row.timestamp else None
+        }
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -225,12 +339,22 @@ class Photo(db.Model):
     filename = db.Column(db.String(255), nullable=False)
     filepath = db.Column(db.String(500), nullable=False)
     cloudinary_public_id = db.Column(db.String(500)) 
+    content_hash = db.Column(db.String(64))  # SHA-256 of the uploaded file, to spot re-uploads
+    upload_status = db.Column(db.String(20), nullable=False, server_default='uploaded')  # pending, uploaded
     caption = db.Column(db.String(200))
     photo_type = db.Column(db.String(20), default='general')  # before, after, issue, general
-    uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
+    uploaded_at = db.Column(db.DateTime, nullable=False, server_default=utc_now())
     
     user = db.relationship('User')
     
+    __table_args__ = (
+        # Photo counts per penetration, cascade deletes and per-pen photo lists in
+        # upload order (read backwards for newest first)
+        db.Index('ix_photos_penetration_uploaded', 'penetration_id', 'uploaded_at'),
+        # Duplicate check before uploading: same file already attached to this pen?
+        db.Index('ix_photos_penetration_hash', 'penetration_id', 'content_hash'),
+    )
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -240,6 +364,7 @@ class Photo(db.Model):
             'filename': self.filename,
             'filepath': self.filepath,
             'cloudinary_public_id': self.cloudinary_public_id,
+            'upload_status': self.upload_status,
             'caption': self.caption,
             'photo_type': self.photo_type,
             'uploaded_at': self.uploaded_at.isoformat() if self.uploaded_at else None
@@ -256,7 +381,7 @@ class ContractorRegistration(db.Model):
     contact_email = db.Column(db.String(120), nullable=False)
     status = db.Column(db.String(20), default='pending')  # pending, approved, rejected
     rejection_reason = db.Column(db.Text)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, server_default=utc_now())
     reviewed_at = db.Column(db.DateTime)
     reviewed_by = db.Column(db.Integer, db.ForeignKey('users.id'))
     
@@ -286,15 +411,26 @@ class ContractorAccessToken(db.Model):
     token = db.Column(db.String(64), unique=True, nullable=False)
     active = db.Column(db.Boolean, default=True)
     expires_at = db.Column(db.DateTime)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, server_default=utc_now())
     last_used_at = db.Column(db.DateTime)
     
     contractor = db.relationship('Contractor')
     
+    __table_args__ = (
+        # Only active links are ever looked up by project/contractor
+        db.Index('ix_contractor_access_tokens_active_project', 'project_id', 'contractor_id',
+                 postgresql_where=db.text('active')),
+    )
+    
     @staticmethod
     def generate_token():
         """Generate a secure random token"""
-        return secrets.token_urlsafe(32)
+        return urlsafe_tokens(1, 32)[0]
+    
+    @staticmethod
+    def generate_tokens(count):
+        """Generate many secure random tokens at once for bulk invite issuance"""
+        return urlsafe_tokens(count, 32)
     
     def is_valid(self):
         """Check if token is still valid"""
@@ -331,13 +467,24 @@ class AccessRequest(db.Model):
     ready_to_test = db.Column(db.Boolean, default=False)
     message = db.Column(db.Text)
     status = db.Column(db.String(20), default='pending')  # pending, contacted, approved, rejected
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, server_default=utc_now())
     reviewed_at = db.Column(db.DateTime)
     reviewed_by = db.Column(db.Integer, db.ForeignKey('users.id'))
     notes = db.Column(db.Text)
     
     reviewer = db.relationship('User')
     
+    __table_args__ = (
+        db.Index('idx_access_requests_email', 'email'),  # Created by run_migration.py
+        db.Index('ix_access_requests_status_created', 'status', 'created_at'),
+        # Default admin list: pending requests newest first, read in index order
+        db.Index('ix_access_requests_pending_created', db.text('created_at DESC'),
+                 postgresql_where=db.text("status = 'pending'")),
+        # At most one pending request per email
+        db.Index('ux_access_requests_pending_email', 'email', unique=True,
+                 postgresql_where=db.text("status = 'pending'")),
+    )
+    
     def to_dict(self):
         return {
             'id': self.id,
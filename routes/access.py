@@ -1,49 +1,82 @@
-from flask import Blueprint, request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt_identity
-from app import db
-from models import AccessRequest, User
+from flask import Blueprint, request, jsonify, g
+from flask_jwt_extended import jwt_required
+from datetime import datetime
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from app import db, cache
+from models import AccessRequest
+from utils.auth import admin_required
+from utils.cache import cache_version, bump_cache_version, cacheable_response
+from utils.responses import json_response
 
 access_bp = Blueprint('access', __name__)
 
+# Per-field normalization for public access request submissions
+_CLEANERS = {
+    'name': str.strip,
+    'email': lambda s: s.strip().lower(),
+    'company': str.strip,
+    'role': str.strip,
+    'drydock_date': str.strip,
+    'message': str.strip,
+    'ready_to_test': bool
+}
+_REQUIRED = ('name', 'email', 'company', 'role')
+
+def access_requests_cache_key(*args, **kwargs):
+    """Cache admin access request lists per endpoint and status filter"""
+    return f"access_requests:{cache_version('access_requests')}:{request.path}:{request.args.get('status')}"
+
 @access_bp.route('/request', methods=['POST'])
 def create_access_request():
     """Public endpoint for requesting access from landing page"""
     try:
         data = request.get_json()
         
+        # Normalize each known field once, dropping empty values
+        cleaned = {}
+        for field, clean in _CLEANERS.items():
+            value = data.get(field)
+            if value:
+                value = clean(value)
+                if value:
+                    cleaned[field] = value
+        
         # Validate required fields
-        required = ['name', 'email', 'company', 'role']
-        for field in required:
-            if not data.get(field):
-                return jsonify({'error': f'{field} is required'}), 400
-        
-        # Check if email already requested
-        existing = AccessRequest.query.filter_by(
-            email=data['email'], 
+        missing = [field for field in _REQUIRED if field not in cleaned]
+        if missing:
+            return jsonify({'error': f'{missing[0]} is required'}), 400
+        
+        # Create request - the pending-email unique index skips the insert if the
+        # email already has a pending request, so no separate existence check is needed
+        stmt = insert(AccessRequest).values(
+            name=cleaned['name'],
+            email=cleaned['email'],
+            company=cleaned['company'],
+            role=cleaned['role'],
+            drydock_date=cleaned.get('drydock_date'),
+            ready_to_test=cleaned.get('ready_to_test', False),
+            message=cleaned.get('message'),
             status='pending'
-        ).first()
-        if existing:
+        ).on_conflict_do_nothing(
+            index_elements=['email'],
+            index_where=db.text("status = 'pending'")
+        ).returning(AccessRequest.id)
+        
+        request_id = db.session.execute(stmt).scalar()
+        if request_id is None:
+            db.session.rollback()
             return jsonify({'error': 'You already have a pending access request'}), 409
         
-        # Create request
-        access_request = AccessRequest(
-            name=data['name'].strip(),
-            email=data['email'].strip().lower(),
-            company=data['company'].strip(),
-            role=data['role'].strip(),
-            drydock_date=data.get('drydock_date', '').strip() if data.get('drydock_date') else None,
-            ready_to_test=data.get('ready_to_test', False),
-            message=data.get('message', '').strip() if data.get('message') else None
-        )
-        
-        db.session.add(access_request)
         db.session.commit()
+        bump_cache_version('access_requests')
         
         # TODO: Send email notification to admin
         
         return jsonify({
             'message': 'Access request submitted successfully',
-            'id': access_request.id
+            'id': request_id
         }), 201
         
     except Exception as e:
@@ -52,43 +85,31 @@ def create_access_request():
 
 @access_bp.route('/requests', methods=['GET'])
 @jwt_required()
+@admin_required
+@cache.cached(timeout=30, make_cache_key=access_requests_cache_key, response_filter=cacheable_response)
 def get_access_requests():
     """Get all access requests (admin only)"""
     try:
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
-        
-        # Only admin can view requests
-        if current_user.username != 'admin':
-            return jsonify({'error': 'Unauthorized'}), 403
-        
         status = request.args.get('status')
         
-        query = AccessRequest.query
+        query = AccessRequest.query.options(joinedload(AccessRequest.reviewer))
         if status:
             query = query.filter_by(status=status)
         
         requests = query.order_by(AccessRequest.created_at.desc()).all()
         
-        return jsonify([r.to_dict() for r in requests]), 200
+        return json_response([r.to_dict() for r in requests])
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @access_bp.route('/requests/<int:request_id>', methods=['PUT'])
 @jwt_required()
+@admin_required
 def update_access_request(request_id):
     """Update access request status (admin only)"""
     try:
-        from datetime import datetime
-        
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
-        
-        if current_user.username != 'admin':
-            return jsonify({'error': 'Unauthorized'}), 403
-        
-        access_request = AccessRequest.query.get(request_id)
+        access_request = db.session.get(AccessRequest, request_id)
         if not access_request:
             return jsonify({'error': 'Request not found'}), 404
         
@@ -97,12 +118,19 @@ def update_access_request(request_id):
         if 'status' in data:
             access_request.status = data['status']
             access_request.reviewed_at = datetime.utcnow()
-            access_request.reviewed_by = user_id
+            access_request.reviewed_by = g.user_id
         
         if 'notes' in data:
             access_request.notes = data['notes']
         
-        db.session.commit()
+        # Reopening as 'pending' trips the pending-email unique index when the
+        # email has submitted a newer request since
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return jsonify({'error': 'This email already has a pending access request'}), 409
+        bump_cache_version('access_requests')
         
         return jsonify({
             'message': 'Request updated successfully',
@@ -1,55 +1,71 @@
-from flask import Blueprint, request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt_identity
+from flask import Blueprint, request, jsonify, g
+from flask_jwt_extended import verify_jwt_in_request
 from datetime import datetime
-from app import db
+from sqlalchemy.orm import joinedload
+from app import db, cache
 from models import AccessRequest, User
+from routes.access import access_requests_cache_key
+from utils.auth import load_identity
+from utils.cache import bump_cache_version, cacheable_response
+from utils.responses import json_response
 from werkzeug.security import generate_password_hash
-import secrets
+import os
 import string
 
 admin_bp = Blueprint('admin', __name__)
 
+@admin_bp.before_request
+def require_reviewer():
+    """Authenticate once for every admin route (admin/supervisor only)"""
+    if request.method == 'OPTIONS':
+        return  # Let CORS preflight through without a token
+    
+    verify_jwt_in_request()
+    load_identity()
+    
+    if g.claims.get('role') not in ['supervisor', 'admin']:
+        return jsonify({'error': 'Unauthorized'}), 403
+
+PASSWORD_ALPHABET = string.ascii_letters + string.digits + "!@#$%"
+# Largest multiple of the alphabet size below 256; bytes above it are dropped to avoid modulo bias
+_PASSWORD_BYTE_LIMIT = 256 - 256 % len(PASSWORD_ALPHABET)
+
 def generate_temp_password(length=12):
-    """Generate a secure temporary password"""
-    chars = string.ascii_letters + string.digits + "!@#$%"
-    return ''.join(secrets.choice(chars) for _ in range(length))
+    """Generate a secure temporary password from one os.urandom call"""
+    chars = []
+    while len(chars) < length:
+        chars.extend(
+            PASSWORD_ALPHABET[b % len(PASSWORD_ALPHABET)]
+            for b in os.urandom(length * 2) if b < _PASSWORD_BYTE_LIMIT
+        )
+    return ''.join(chars[:length])
 
 @admin_bp.route('/access-requests', methods=['GET'])
-@jwt_required()
 def get_access_requests():
     """Get all access requests (admin/supervisor only)"""
     try:
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
-        
-        if current_user.role not in ['supervisor', 'admin']:
-            return jsonify({'error': 'Unauthorized'}), 403
-        
-        status = request.args.get('status', 'pending')
-        
-        query = AccessRequest.query
-        if status:
-            query = query.filter_by(status=status)
-        
-        requests = query.order_by(AccessRequest.created_at.desc()).all()
-        
-        return jsonify([r.to_dict() for r in requests]), 200
+        return _list_access_requests()
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@cache.cached(timeout=30, make_cache_key=access_requests_cache_key, response_filter=cacheable_response)
+def _list_access_requests():
+    status = request.args.get('status', 'pending')
+    
+    query = AccessRequest.query.options(joinedload(AccessRequest.reviewer))
+    if status:
+        query = query.filter_by(status=status)
+    
+    requests = query.order_by(AccessRequest.created_at.desc()).all()
+    
+    return json_response([r.to_dict() for r in requests])
+
 @admin_bp.route('/access-requests/<int:request_id>/approve', methods=['POST'])
-@jwt_required()
 def approve_access_request(request_id):
     """Approve access request and create user account"""
     try:
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
-        
-        if current_user.role not in ['supervisor', 'admin']:
-            return jsonify({'error': 'Unauthorized'}), 403
-        
-        access_request = AccessRequest.query.get(request_id)
+        access_request = db.session.get(AccessRequest, request_id)
         if not access_request:
             return jsonify({'error': 'Request not found'}), 404
         
@@ -77,9 +93,10 @@ def approve_access_request(request_id):
         # Update access request
         access_request.status = 'approved'
         access_request.reviewed_at = datetime.utcnow()
-        access_request.reviewed_by = user_id
+        access_request.reviewed_by = g.user_id
         
         db.session.commit()
+        bump_cache_version('access_requests')
         
         return jsonify({
             'message': 'Access request approved',
@@ -93,17 +110,10 @@ def approve_access_request(request_id):
         return jsonify({'error': str(e)}), 500
 
 @admin_bp.route('/access-requests/<int:request_id>/reject', methods=['POST'])
-@jwt_required()
 def reject_access_request(request_id):
     """Reject access request"""
     try:
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
-        
-        if current_user.role not in ['supervisor', 'admin']:
-            return jsonify({'error': 'Unauthorized'}), 403
-        
-        access_request = AccessRequest.query.get(request_id)
+        access_request = db.session.get(AccessRequest, request_id)
         if not access_request:
             return jsonify({'error': 'Request not found'}), 404
         
@@ -115,9 +125,10 @@ def reject_access_request(request_id):
         access_request.status = 'rejected'
         access_request.rejection_reason = data.get('reason', 'No reason provided')
         access_request.reviewed_at = datetime.utcnow()
-        access_request.reviewed_by = user_id
+        access_request.reviewed_by = g.user_id
         
         db.session.commit()
+        bump_cache_version('access_requests')
         
         return jsonify({
             'message': 'Access request rejected',
@@ -1,8 +1,9 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, g
 from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity
 from werkzeug.security import generate_password_hash, check_password_hash
 from app import db
 from models import User, Contractor
+from utils.auth import load_identity, user_claims
 
 auth_bp = Blueprint('auth', __name__)
 
@@ -35,7 +36,7 @@ def register():
             if not contractor_id:
                 return jsonify({'error': 'Contractor ID required for contractor role'}), 400
             
-            contractor = Contractor.query.get(contractor_id)
+            contractor = db.session.get(Contractor, contractor_id)
             if not contractor:
                 return jsonify({'error': 'Invalid contractor ID'}), 400
         
@@ -74,8 +75,8 @@ def login():
         if not user or not check_password_hash(user.password_hash, data['password']):
             return jsonify({'error': 'Invalid credentials'}), 401
         
-        # Create access token with user ID as string
-        access_token = create_access_token(identity=str(user.id))
+        # Create access token with user ID as string and role claims for authorization
+        access_token = create_access_token(identity=str(user.id), additional_claims=user_claims(user))
         
         return jsonify({
             'access_token': access_token,
@@ -91,7 +92,7 @@ def get_current_user():
     """Get current user profile"""
     try:
         user_id = int(get_jwt_identity())
-        user = User.query.get(user_id)
+        user = db.session.get(User, user_id)
         
         if not user:
             return jsonify({'error': 'User not found'}), 404
@@ -106,10 +107,9 @@ def get_current_user():
 def get_users():
     """Get all users (supervisor only)"""
     try:
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
+        load_identity()
         
-        if current_user.role != 'supervisor':
+        if g.claims.get('role') != 'supervisor':
             return jsonify({'error': 'Unauthorized'}), 403
         
         users = User.query.all()
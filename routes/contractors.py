@@ -1,24 +1,55 @@
-from flask import Blueprint, request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt_identity
-from app import db
-from models import Contractor, User
-from urllib.parse import urlencode
+from flask import Blueprint, current_app, request, jsonify
+from flask_jwt_extended import jwt_required
+from sqlalchemy import func, update, delete, text
+from sqlalchemy.orm import defer
+from sqlalchemy.dialects.postgresql import insert
+from app import db, cache
+from models import Contractor, ContractorAccessToken, Penetration, Project, User
+from utils.auth import role_required
+from utils.cache import cache_version, bump_cache_version, cacheable_response
+from utils.responses import json_response
 
 contractors_bp = Blueprint('contractors', __name__)
 
+MAGIC_LINK_PREFIX = 'https://app.penlog.io/report/'
+
+# Active access links for a project as a ready-to-send JSON array (NULL when there are none).
+# Cast to text so the driver hands back the JSON string instead of parsing it.
+ACCESS_LINKS_SQL = text("""
+    SELECT json_agg(json_build_object(
+        'contractor_id', t.contractor_id,
+        'contractor_name', COALESCE(c.name, 'Pending First Access'),
+        'token', t.token,
+        'magic_link', :prefix || t.token,
+        'last_used', t.last_used_at,
+        'created_at', t.created_at
+    ) ORDER BY t.id)::text
+    FROM contractor_access_tokens t
+    LEFT JOIN contractors c ON c.id = t.contractor_id
+    WHERE t.project_id = :project_id AND t.active
+""")
+
+def contractors_cache_key(*args, **kwargs):
+    """Cache the contractor list per active_only filter"""
+    active_only = request.args.get('active_only', 'false').lower() == 'true'
+    return f"contractors:{cache_version('contractors')}:{active_only}"
+
 @contractors_bp.route('/', methods=['GET'])
 @jwt_required()
+@cache.cached(timeout=60, make_cache_key=contractors_cache_key, response_filter=cacheable_response)
 def get_contractors():
     """Get all contractors"""
     try:
         active_only = request.args.get('active_only', 'false').lower() == 'true'
         
+        # created_at isn't part of to_dict(), so don't fetch it
+        query = Contractor.query.options(defer(Contractor.created_at))
         if active_only:
-            contractors = Contractor.query.filter_by(active=True).all()
-        else:
-            contractors = Contractor.query.all()
+            query = query.filter_by(active=True)
         
-        return jsonify([contractor.to_dict() for contractor in contractors]), 200
+        contractors = query.all()
+        
+        return json_response([contractor.to_dict() for contractor in contractors])
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -28,7 +59,7 @@ def get_contractors():
 def get_contractor(contractor_id):
     """Get single contractor"""
     try:
-        contractor = Contractor.query.get(contractor_id)
+        contractor = db.session.get(Contractor, contractor_id)
         if not contractor:
             return jsonify({'error': 'Contractor not found'}), 404
         
@@ -39,34 +70,32 @@ def get_contractor(contractor_id):
 
 @contractors_bp.route('/', methods=['POST'])
 @jwt_required()
+@role_required('supervisor', 'admin')
 def create_contractor():
     """Create new contractor (supervisor only)"""
     try:
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
-        
-        if current_user.role not in ['supervisor', 'admin']:
-            return jsonify({'error': 'Unauthorized'}), 403
-        
         data = request.get_json()
         
         if not data.get('name'):
             return jsonify({'error': 'Contractor name required'}), 400
         
-        # Check if contractor already exists
-        if Contractor.query.filter_by(name=data['name']).first():
-            return jsonify({'error': 'Contractor already exists'}), 400
+        # Insert unless the name is taken - one atomic round-trip instead of SELECT then INSERT
+        contractor = db.session.scalars(
+            insert(Contractor).values(
+                name=data['name'],
+                contact_person=data.get('contact_person'),
+                contact_email=data.get('contact_email'),
+                contact_phone=data.get('contact_phone'),
+                active=data.get('active', True)
+            ).on_conflict_do_nothing(index_elements=['name']).returning(Contractor)
+        ).first()
         
-        contractor = Contractor(
-            name=data['name'],
-            contact_person=data.get('contact_person'),
-            contact_email=data.get('contact_email'),
-            contact_phone=data.get('contact_phone'),
-            active=data.get('active', True)
-        )
+        if contractor is None:
+            db.session.rollback()
+            return jsonify({'error': 'Contractor already exists'}), 400
         
-        db.session.add(contractor)
         db.session.commit()
+        bump_cache_version('contractors')
         
         return jsonify({
             'message': 'Contractor created successfully',
@@ -79,16 +108,11 @@ def create_contractor():
 
 @contractors_bp.route('/<int:contractor_id>', methods=['PUT'])
 @jwt_required()
+@role_required('supervisor', 'admin')
 def update_contractor(contractor_id):
     """Update contractor (supervisor only)"""
     try:
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
-        
-        if current_user.role not in ['supervisor', 'admin']:
-            return jsonify({'error': 'Unauthorized'}), 403
-        
-        contractor = Contractor.query.get(contractor_id)
+        contractor = db.session.get(Contractor, contractor_id)
         if not contractor:
             return jsonify({'error': 'Contractor not found'}), 404
         
@@ -101,6 +125,7 @@ def update_contractor(contractor_id):
                 setattr(contractor, field, data[field])
         
         db.session.commit()
+        bump_cache_version('contractors')
         
         return jsonify({
             'message': 'Contractor updated successfully',
@@ -116,27 +141,31 @@ def update_contractor(contractor_id):
 def get_contractor_stats(contractor_id):
     """Get statistics for a contractor"""
     try:
-        contractor = Contractor.query.get(contractor_id)
+        contractor = db.session.get(Contractor, contractor_id)
         if not contractor:
             return jsonify({'error': 'Contractor not found'}), 404
         
-        from sqlalchemy import func
-        from models import Penetration
-        
-        # Count penetrations by status
-        stats = db.session.query(
-            Penetration.status,
-            func.count(Penetration.id)
-        ).filter_by(contractor_id=contractor_id).group_by(Penetration.status).all()
-        
-        status_counts = {status: count for status, count in stats}
-        total = sum(status_counts.values())
+        # Count all statuses in one pass (served by the contractor/status index)
+        row = db.session.query(
+            func.count(Penetration.id).label('total'),
+            func.count(Penetration.id).filter(Penetration.status == 'not_started').label('not_started'),
+            func.count(Penetration.id).filter(Penetration.status == 'open').label('open'),
+            func.count(Penetration.id).filter(Penetration.status == 'closed').label('closed'),
+            func.count(Penetration.id).filter(Penetration.status == 'verified').label('verified')
+        ).filter(Penetration.contractor_id == contractor_id).one()
+        
+        total = row.total
+        status_counts = {
+            status: count
+            for status, count in row._asdict().items()
+            if status != 'total' and count
+        }
         
         return jsonify({
             'contractor': contractor.to_dict(),
             'total_penetrations': total,
             'status_breakdown': status_counts,
-            'completion_rate': round((status_counts.get('verified', 0) / total * 100), 2) if total > 0 else 0
+            'completion_rate': round(row.verified / total * 100, 2) if total else 0
         }), 200
         
     except Exception as e:
@@ -144,15 +173,10 @@ def get_contractor_stats(contractor_id):
 
 @contractors_bp.route('/generate-link', methods=['POST'])
 @jwt_required()
+@role_required('supervisor', 'admin')
 def generate_magic_link():
     """UNIFIED: Generate magic link for new OR existing contractor - ONE LINK WORKFLOW"""
     try:
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
-        
-        if current_user.role not in ['supervisor', 'admin']:
-            return jsonify({'error': 'Unauthorized'}), 403
-        
         data = request.get_json()
         project_id = data.get('project_id')
         contractor_name = data.get('contractor_name')
@@ -162,47 +186,45 @@ def generate_magic_link():
         if not project_id or not contractor_name:
             return jsonify({'error': 'Project ID and contractor name required'}), 400
         
-        from models import Project, ContractorAccessToken
-        
-        project = Project.query.get(project_id)
+        project = db.session.get(Project, project_id)
         if not project:
             return jsonify({'error': 'Project not found'}), 404
         
-        # Check if contractor already exists
-        contractor = Contractor.query.filter_by(name=contractor_name).first()
-        
-        # If contractor doesn't exist, create it now
-        if not contractor:
-            contractor = Contractor(
+        # Create the contractor if the name is new; fall back to the existing row otherwise
+        contractor_id = db.session.execute(
+            insert(Contractor).values(
                 name=contractor_name,
                 contact_person=contact_person,
                 contact_email=contact_email,
                 active=True
-            )
-            db.session.add(contractor)
-            db.session.flush()  # Get the contractor.id before creating token
+            ).on_conflict_do_nothing(index_elements=['name']).returning(Contractor.id)
+        ).scalar()
+        
+        contractor_created = contractor_id is not None
+        if not contractor_created:
+            contractor_id = db.session.query(Contractor.id).filter_by(name=contractor_name).scalar()
         
         # Check for existing token
         existing_token = ContractorAccessToken.query.filter_by(
             project_id=project_id,
-            contractor_id=contractor.id,
+            contractor_id=contractor_id,
             active=True
         ).first()
         
         if existing_token:
-            magic_url = f"https://app.penlog.io/report/{existing_token.token}"
+            magic_url = MAGIC_LINK_PREFIX + existing_token.token
             
             return jsonify({
                 'message': 'Access link already exists for this contractor',
                 'link': magic_url,
                 'token': existing_token.token,
-                'contractor_id': contractor.id
+                'contractor_id': contractor_id
             }), 200
         
         # Generate new token with contractor_id
         token = ContractorAccessToken(
             project_id=project_id,
-            contractor_id=contractor.id,  # Now always has a value
+            contractor_id=contractor_id,  # Now always has a value
             token=ContractorAccessToken.generate_token(),
             active=True,
             expires_at=project.embarkation_date
@@ -210,15 +232,17 @@ def generate_magic_link():
         
         db.session.add(token)
         db.session.commit()
+        if contractor_created:
+            bump_cache_version('contractors')
         
         # Build URL
-        magic_url = f"https://app.penlog.io/report/{token.token}"
+        magic_url = MAGIC_LINK_PREFIX + token.token
         
         return jsonify({
             'message': 'Access link generated successfully',
             'link': magic_url,
             'token': token.token,
-            'contractor_id': contractor.id
+            'contractor_id': contractor_id
         }), 201
         
     except Exception as e:
@@ -227,15 +251,10 @@ def generate_magic_link():
 
 @contractors_bp.route('/merge', methods=['POST'])
 @jwt_required()
+@role_required('supervisor', 'admin')
 def merge_contractors():
     """Merge two contractors (supervisor only)"""
     try:
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
-        
-        if current_user.role not in ['supervisor', 'admin']:
-            return jsonify({'error': 'Unauthorized'}), 403
-        
         data = request.get_json()
         
         source_id = data.get('source_contractor_id')
@@ -244,33 +263,41 @@ def merge_contractors():
         if not source_id or not target_id:
             return jsonify({'error': 'Both source and target contractor IDs required'}), 400
         
+        source_id, target_id = int(source_id), int(target_id)
+        
         if source_id == target_id:
             return jsonify({'error': 'Cannot merge contractor with itself'}), 400
         
-        source = Contractor.query.get(source_id)
-        target = Contractor.query.get(target_id)
+        contractors = {c.id: c for c in Contractor.query.filter(Contractor.id.in_([source_id, target_id]))}
+        source = contractors.get(source_id)
+        target = contractors.get(target_id)
         
         if not source or not target:
             return jsonify({'error': 'Contractor not found'}), 404
         
-        from models import Penetration
+        source_name = source.name
         
-        # Move all penetrations from source to target
-        Penetration.query.filter_by(contractor_id=source_id).update({'contractor_id': target_id})
-        
-        # Move all users from source to target
-        User.query.filter_by(contractor_id=source_id).update({'contractor_id': target_id})
-        
-        # Move all access tokens from source to target
-        from models import ContractorAccessToken
-        ContractorAccessToken.query.filter_by(contractor_id=source_id).update({'contractor_id': target_id})
+        # Repoint penetrations, users and access tokens with bulk UPDATEs, then drop the
+        # source row - all in one transaction, without loading the rows into the session
+        for model in (Penetration, User, ContractorAccessToken):
+            db.session.execute(
+                update(model)
+                .where(model.contractor_id == source_id)
+                .values(contractor_id=target_id)
+                .execution_options(synchronize_session=False)
+            )
         
-        # Delete source contractor
-        db.session.delete(source)
+        db.session.execute(
+            delete(Contractor)
+            .where(Contractor.id == source_id)
+            .execution_options(synchronize_session=False)
+        )
         db.session.commit()
+        bump_cache_version('contractors')
+        bump_cache_version('penetrations')  # Penetrations moved to the target contractor
         
         return jsonify({
-            'message': f'Successfully merged {source.name} into {target.name}',
+            'message': f'Successfully merged {source_name} into {target.name}',
             'contractor': target.to_dict()
         }), 200
         
@@ -280,65 +307,27 @@ def merge_contractors():
 
 @contractors_bp.route('/project/<int:project_id>/access-links', methods=['GET'])
 @jwt_required()
+@role_required('supervisor', 'admin')
 def get_project_contractor_links(project_id):
     """Get all contractor access links for a project (supervisor only)"""
     try:
-        from models import ContractorAccessToken
-        
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
+        # Postgres builds the whole JSON array, so no rows are hydrated or re-encoded here
+        body = db.session.execute(ACCESS_LINKS_SQL, {
+            'project_id': project_id,
+            'prefix': MAGIC_LINK_PREFIX
+        }).scalar()
         
-        if current_user.role not in ['supervisor', 'admin']:
-            return jsonify({'error': 'Unauthorized'}), 403
-        
-        # Get all active tokens for this project
-        tokens = ContractorAccessToken.query.filter_by(
-            project_id=project_id,
-            active=True
-        ).all()
-        
-        result = []
-        for token in tokens:
-            # Handle tokens that don't have contractor yet (pending first access)
-            if token.contractor:
-                contractor_name = token.contractor.name
-                contact_person = token.contractor.contact_person or ''
-                contact_email = token.contractor.contact_email or ''
-            else:
-                contractor_name = 'Pending First Access'
-                contact_person = ''
-                contact_email = ''
-            
-            # Build URL with contractor details
-            magic_url = f"https://app.penlog.io/report/{token.token}"
-            
-            result.append({
-                'contractor_id': token.contractor_id,
-                'contractor_name': contractor_name,
-                'token': token.token,
-                'magic_link': magic_url,
-                'last_used': token.last_used_at.isoformat() if token.last_used_at else None,
-                'created_at': token.created_at.isoformat() if token.created_at else None
-            })
-        
-        return jsonify(result), 200
+        return current_app.response_class(body or '[]', mimetype='application/json')
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @contractors_bp.route('/project/<int:project_id>/token/<token>/regenerate', methods=['POST'])
 @jwt_required()
+@role_required('supervisor', 'admin')
 def regenerate_magic_link(project_id, token):
     """Regenerate magic link for a contractor (supervisor only)"""
     try:
-        from models import ContractorAccessToken
-        
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
-        
-        if current_user.role not in ['supervisor', 'admin']:
-            return jsonify({'error': 'Unauthorized'}), 403
-        
         # Find old token
         old_token = ContractorAccessToken.query.filter_by(
             project_id=project_id,
@@ -364,7 +353,7 @@ def regenerate_magic_link(project_id, token):
         db.session.commit()
         
         # Build URL
-        magic_url = f"https://app.penlog.io/report/{new_token.token}"
+        magic_url = MAGIC_LINK_PREFIX + new_token.token
         
         return jsonify({
             'message': 'Magic link regenerated successfully',
@@ -1,63 +1,92 @@
 from flask import Blueprint, request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt_identity
-from sqlalchemy import func
-from app import db
-from models import Penetration, Contractor, PenActivity, User
+from flask_jwt_extended import jwt_required
+from sqlalchemy import func, cast, Float, Numeric
+from sqlalchemy.orm import joinedload
+from app import db, cache
+from models import Penetration, Contractor, PenActivity
+from utils.auth import current_claims, role_required
+from utils.cache import cache_version, cacheable_response
 from datetime import datetime, timedelta
 
 dashboard_bp = Blueprint('dashboard', __name__)
 
+STATUSES = ('not_started', 'open', 'closed', 'verified')
+
+def completion_rate_column():
+    """Verified share of penetrations as a percentage rounded to 2dp (0 when there are none)"""
+    # Postgres only has round(numeric, int); cast back to float so the JSON holds a number
+    rate = func.round(
+        cast(func.count(Penetration.id).filter(Penetration.status == 'verified'), Numeric) * 100
+        / func.nullif(func.count(Penetration.id), 0),
+        2
+    )
+    return func.coalesce(cast(rate, Float), 0).label('completion_rate')
+
+def status_count_columns():
+    """Total, one COUNT(*) FILTER column per status and the completion rate, for one-row-per-group breakdowns"""
+    return [func.count(Penetration.id).label('total')] + [
+        func.count(Penetration.id).filter(Penetration.status == status).label(status)
+        for status in STATUSES
+    ] + [completion_rate_column()]
+
+def dashboard_cache_key(*args, **kwargs):
+    """Cache dashboard aggregates per endpoint and caller scope until penetrations or contractors change"""
+    claims = current_claims()
+    return (
+        f"dashboard:{cache_version('penetrations')}:{cache_version('contractors')}:"
+        f"{request.path}:{claims.get('role')}:{claims.get('contractor_id')}"
+    )
+
 @dashboard_bp.route('/overview', methods=['GET'])
 @jwt_required()
+@cache.cached(timeout=30, make_cache_key=dashboard_cache_key, response_filter=cacheable_response)
 def get_overview():
     """Get dashboard overview statistics"""
     try:
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
-        
-        # Base query
-        query = Penetration.query
+        claims = current_claims()
+        
+        # Every status and priority bucket in one aggregate query
+        counts = db.session.query(
+            func.count(Penetration.id).label('total'),
+            func.count(Penetration.id).filter(Penetration.status == 'not_started').label('not_started'),
+            func.count(Penetration.id).filter(Penetration.status == 'open').label('open'),
+            func.count(Penetration.id).filter(Penetration.status == 'closed').label('closed'),
+            func.count(Penetration.id).filter(Penetration.status == 'verified').label('verified'),
+            func.count(Penetration.id).filter(Penetration.priority == 'critical').label('critical'),
+            func.count(Penetration.id).filter(Penetration.priority == 'important').label('important'),
+            func.count(Penetration.id).filter(Penetration.priority == 'routine').label('routine'),
+            completion_rate_column()
+        )
         
         # If contractor user, filter to their penetrations only
-        if current_user.role == 'contractor':
-            query = query.filter_by(contractor_id=current_user.contractor_id)
-        
-        # Total counts by status
-        total = query.count()
-        not_started = query.filter_by(status='not_started').count()
-        open_count = query.filter_by(status='open').count()
-        closed = query.filter_by(status='closed').count()
-        verified = query.filter_by(status='verified').count()
+        if claims.get('role') == 'contractor':
+            counts = counts.filter(Penetration.contractor_id == claims.get('contractor_id'))
         
-        # Calculate completion percentage
-        completion_rate = round((verified / total * 100), 2) if total > 0 else 0
-        
-        # Count by priority
-        critical = query.filter_by(priority='critical').count()
-        important = query.filter_by(priority='important').count()
-        routine = query.filter_by(priority='routine').count()
+        counts = counts.one()
         
         # Recent activity (last 24 hours)
         yesterday = datetime.utcnow() - timedelta(days=1)
-        recent_activities = PenActivity.query.filter(
-            PenActivity.timestamp >= yesterday
-        ).order_by(PenActivity.timestamp.desc()).limit(10).all()
+        recent_activities = db.session.execute(
+            PenActivity.feed_select().filter(
+                PenActivity.timestamp >= yesterday
+            ).order_by(PenActivity.timestamp.desc()).limit(10)
+        ).all()
         
         return jsonify({
-            'total_penetrations': total,
+            'total_penetrations': counts.total,
             'status_breakdown': {
-                'not_started': not_started,
-                'open': open_count,
-                'closed': closed,
-                'verified': verified
+                'not_started': counts.not_started,
+                'open': counts.open,
+                'closed': counts.closed,
+                'verified': counts.verified
             },
-            'completion_rate': completion_rate,
+            'completion_rate': counts.completion_rate,
             'priority_breakdown': {
-                'critical': critical,
-                'important': important,
-                'routine': routine
+                'critical': counts.critical,
+                'important': counts.important,
+                'routine': counts.routine
             },
-            'recent_activities': [activity.to_dict() for activity in recent_activities]
+            'recent_activities': [PenActivity.feed_dict(row) for row in recent_activities]
         }), 200
         
     except Exception as e:
@@ -65,99 +94,40 @@ def get_overview():
 
 @dashboard_bp.route('/by-contractor', methods=['GET'])
 @jwt_required()
+@role_required('supervisor')
+@cache.cached(timeout=60, make_cache_key=dashboard_cache_key, response_filter=cacheable_response)
 def get_by_contractor():
     """Get penetrations grouped by contractor"""
     try:
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
-        
-        if current_user.role != 'supervisor':
-            return jsonify({'error': 'Unauthorized'}), 403
-        
-        # Get all contractors with their penetration counts
-        contractors_stats = db.session.query(
+        # One row per contractor with every status bucket; contractors without
+        # penetrations still appear (outer join) with zero counts
+        rows = db.session.query(
             Contractor.id,
             Contractor.name,
-            Penetration.status,
-            func.count(Penetration.id).label('count')
+            *status_count_columns()
         ).outerjoin(Penetration).group_by(
             Contractor.id,
-            Contractor.name,
-            Penetration.status
-        ).all()
+            Contractor.name
+        ).order_by(Contractor.id).all()
         
-        # Organize data by contractor
-        contractor_data = {}
-        for contractor_id, contractor_name, status, count in contractors_stats:
-            if contractor_id not in contractor_data:
-                contractor_data[contractor_id] = {
-                    'id': contractor_id,
-                    'name': contractor_name,
-                    'total': 0,
-                    'not_started': 0,
-                    'open': 0,
-                    'closed': 0,
-                    'verified': 0,
-                    'completion_rate': 0
-                }
-            
-            if status:
-                contractor_data[contractor_id][status] = count
-                contractor_data[contractor_id]['total'] += count
-        
-        # Calculate completion rates
-        for contractor_id in contractor_data:
-            data = contractor_data[contractor_id]
-            if data['total'] > 0:
-                data['completion_rate'] = round((data['verified'] / data['total'] * 100), 2)
-        
-        return jsonify(list(contractor_data.values())), 200
+        return jsonify([row._asdict() for row in rows]), 200
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @dashboard_bp.route('/by-deck', methods=['GET'])
 @jwt_required()
+@cache.cached(timeout=60, make_cache_key=dashboard_cache_key, response_filter=cacheable_response)
 def get_by_deck():
     """Get penetrations grouped by deck"""
     try:
-        # Get penetration counts by deck and status
-        deck_stats = db.session.query(
+        # One row per deck with every status bucket, sorted by deck name in SQL
+        rows = db.session.query(
             Penetration.deck,
-            Penetration.status,
-            func.count(Penetration.id).label('count')
-        ).group_by(
-            Penetration.deck,
-            Penetration.status
-        ).all()
+            *status_count_columns()
+        ).group_by(Penetration.deck).order_by(Penetration.deck).all()
         
-        # Organize data by deck
-        deck_data = {}
-        for deck, status, count in deck_stats:
-            if deck not in deck_data:
-                deck_data[deck] = {
-                    'deck': deck,
-                    'total': 0,
-                    'not_started': 0,
-                    'open': 0,
-                    'closed': 0,
-                    'verified': 0,
-                    'completion_rate': 0
-                }
-            
-            deck_data[deck][status] = count
-            deck_data[deck]['total'] += count
-        
-        # Calculate completion rates
-        for deck in deck_data:
-            data = deck_data[deck]
-            if data['total'] > 0:
-                data['completion_rate'] = round((data['verified'] / data['total'] * 100), 2)
-        
-        # Sort by deck name
-        sorted_decks = sorted(deck_data.values(), key=lambda x: x['deck'])
-        
-        return jsonify(sorted_decks), 200
+        return jsonify([row._asdict() for row in rows]), 200
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -171,25 +141,34 @@ def get_open_too_long():
         threshold_hours = int(request.args.get('hours', 48))
         threshold_time = datetime.utcnow() - timedelta(hours=threshold_hours)
         
-        # Find penetrations opened before threshold and still open
-        open_pens = Penetration.query.filter_by(status='open').all()
-        
+        # Latest "opened" activity per penetration, joined to open pens with the
+        # threshold applied in SQL (one query instead of one per open pen)
+        last_open = db.session.query(
+            PenActivity.penetration_id,
+            func.max(PenActivity.timestamp).label('opened_at')
+        ).filter(
+            PenActivity.new_status == 'open'
+        ).group_by(PenActivity.penetration_id).subquery()
+        
+        rows = db.session.query(Penetration, last_open.c.opened_at).options(
+            joinedload(Penetration.contractor)
+        ).join(
+            last_open, last_open.c.penetration_id == Penetration.id
+        ).filter(
+            Penetration.status == 'open',
+            last_open.c.opened_at < threshold_time
+        ).order_by(last_open.c.opened_at.asc()).all()
+        
+        photo_counts = Penetration.photo_counts([pen.id for pen, _ in rows])
+        
+        # Longest open first (oldest opened_at)
+        now = datetime.utcnow()
         flagged_pens = []
-        for pen in open_pens:
-            # Get last activity that opened this pen
-            last_open = PenActivity.query.filter_by(
-                penetration_id=pen.id,
-                new_status='open'
-            ).order_by(PenActivity.timestamp.desc()).first()
-            
-            if last_open and last_open.timestamp < threshold_time:
-                pen_dict = pen.to_dict()
-                pen_dict['opened_at'] = last_open.timestamp.isoformat()
-                pen_dict['hours_open'] = round((datetime.utcnow() - last_open.timestamp).total_seconds() / 3600, 1)
-                flagged_pens.append(pen_dict)
-        
-        # Sort by hours open (longest first)
-        flagged_pens.sort(key=lambda x: x['hours_open'], reverse=True)
+        for pen, opened_at in rows:
+            pen_dict = pen.to_dict(photo_count=photo_counts.get(pen.id, 0))
+            pen_dict['opened_at'] = opened_at.isoformat()
+            pen_dict['hours_open'] = round((now - opened_at).total_seconds() / 3600, 1)
+            flagged_pens.append(pen_dict)
         
         return jsonify({
             'threshold_hours': threshold_hours,
@@ -205,7 +184,12 @@ def get_open_too_long():
 def get_critical_status():
     """Get status of critical priority penetrations"""
     try:
-        critical_pens = Penetration.query.filter_by(priority='critical').all()
+        # to_dict() reads every column plus contractor.name, so load contractors in the
+        # same query rather than narrowing columns; buckets are counted from these rows
+        critical_pens = Penetration.query.options(
+            joinedload(Penetration.contractor)
+        ).filter_by(priority='critical').all()
+        photo_counts = Penetration.photo_counts([pen.id for pen in critical_pens])
         
         stats = {
             'total': len(critical_pens),
@@ -218,7 +202,7 @@ def get_critical_status():
         
         for pen in critical_pens:
             stats[pen.status] += 1
-            stats['penetrations'].append(pen.to_dict())
+            stats['penetrations'].append(pen.to_dict(photo_count=photo_counts.get(pen.id, 0)))
         
         stats['completion_rate'] = round((stats['verified'] / stats['total'] * 100), 2) if stats['total'] > 0 else 0
         
@@ -236,16 +220,41 @@ def get_activity_timeline():
         days = int(request.args.get('days', 7))
         start_date = datetime.utcnow() - timedelta(days=days)
         
-        activities = PenActivity.query.filter(
+        # Optional pagination (?page=0&size=50); without size the whole window is returned
+        size = request.args.get('size', type=int)
+        page = request.args.get('page', 0, type=int)
+        if (size is not None and size <= 0) or page < 0:
+            return jsonify({'error': 'page must be >= 0 and size > 0'}), 400
+        
+        # Rows in time order; with the timestamp index a page stops reading after offset + size rows
+        query = PenActivity.feed_select().filter(
             PenActivity.timestamp >= start_date
-        ).order_by(PenActivity.timestamp.desc()).all()
+        ).order_by(PenActivity.timestamp.desc())
         
-        return jsonify({
+        if size:
+            query = query.limit(size).offset(page * size)
+        
+        rows = db.session.execute(query).all()
+        
+        if size:
+            # Counting needs no ORDER BY (or the users join) - keep it off the count query
+            total = db.session.query(func.count(PenActivity.id)).filter(
+                PenActivity.timestamp >= start_date
+            ).scalar()
+        else:
+            total = len(rows)
+        
+        response = {
             'period_days': days,
             'start_date': start_date.isoformat(),
-            'total_activities': len(activities),
-            'activities': [activity.to_dict() for activity in activities]
-        }), 200
+            'total_activities': total,
+            'activities': [PenActivity.feed_dict(row) for row in rows]
+        }
+        if size:
+            response['page'] = page
+            response['size'] = size
+        
+        return jsonify(response), 200
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
\ No newline at end of file
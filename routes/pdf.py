@@ -1,44 +1,49 @@
-from flask import Blueprint, send_file, jsonify, current_app
+from flask import Blueprint, request, send_file, jsonify, current_app, url_for
 from flask_jwt_extended import jwt_required
+from app import db
 from models import Project, Penetration, Contractor
-from utils.pdf_generator import generate_penetration_report, generate_contractor_report
-from utils.excel_generator import generate_penetration_excel
-from utils.package_generator import generate_complete_package
+import os
 from datetime import datetime
+from tempfile import SpooledTemporaryFile
+from services.exports import load_export_penetrations, export_jobs_available, start_complete_package_export, get_export_job, export_job_is_local, export_job_path
+
+# Report generators are imported inside the export views: reportlab, openpyxl
+# and Pillow dominate app start-up time and most processes never export.
 
 pdf_bp = Blueprint('pdf', __name__)
 
-# Excel export endpoint (matches frontend call to /api/pdf/project/:id/excel)
-@pdf_bp.route('/project/<int:project_id>/excel', methods=['OPTIONS'])
-def excel_options(project_id):
-    """Handle OPTIONS preflight for Excel export"""
-    return '', 204
+# Exports are built in memory up to this size, then spill to a temp file so
+# large projects and concurrent exports don't hold whole files in RAM.
+# send_file() streams the result back in blocks and closes it afterwards.
+EXPORT_SPOOL_BYTES = 8 * 1024 * 1024
 
-@pdf_bp.route('/project/<int:project_id>/excel', methods=['GET'])
-@jwt_required()
-def export_excel(project_id):
-    """Export Excel with penetration data only (no photos)"""
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+def export_file():
+    """Binary file object for a generator to write an export into"""
+    return SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+
+def export_filename(project, suffix):
+    """PenLog_<Ship_Name>_<YYYYMMDD><suffix>"""
+    return f"PenLog_{project.ship_name.replace(' ', '_')}_{datetime.now():%Y%m%d}{suffix}"
+
+def run_export(project_id, build, suffix, mimetype, with_photos=False):
+    """Load a project's penetrations, build(project, penetrations, output=...) a file and send it"""
     try:
-        project = Project.query.get(project_id)
+        project = db.session.get(Project, project_id)
         if not project:
             return jsonify({'error': 'Project not found'}), 404
         
-        penetrations = Penetration.query.filter_by(project_id=project_id).all()
+        penetrations = load_export_penetrations(project_id, with_photos=with_photos)
         
         if not penetrations:
             return jsonify({'error': 'No penetrations found for this project'}), 404
         
-        # Generate Excel with just penetration data
-        excel_buffer = generate_penetration_excel(project, penetrations)
-        
-        # Create filename
-        filename = f"PenLog_{project.ship_name.replace(' ', '_')}_{datetime.now().strftime('%Y%m%d')}.xlsx"
-        
         return send_file(
-            excel_buffer,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            build(project, penetrations, output=export_file()),
+            mimetype=mimetype,
             as_attachment=True,
-            download_name=filename
+            download_name=export_filename(project, suffix)
         )
         
     except Exception as e:
@@ -46,6 +51,20 @@ def export_excel(project_id):
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
+# Excel export endpoint (matches frontend call to /api/pdf/project/:id/excel)
+@pdf_bp.route('/project/<int:project_id>/excel', methods=['OPTIONS'])
+def excel_options(project_id):
+    """Handle OPTIONS preflight for Excel export"""
+    return '', 204
+
+@pdf_bp.route('/project/<int:project_id>/excel', methods=['GET'])
+@jwt_required()
+def export_excel(project_id):
+    """Export Excel with penetration data only (no photos)"""
+    from utils.excel_generator import generate_penetration_excel
+    
+    return run_export(project_id, generate_penetration_excel, '.xlsx', XLSX_MIMETYPE)
+
 # PDF export endpoint (matches frontend call to /api/pdf/project/:id)
 @pdf_bp.route('/project/<int:project_id>', methods=['OPTIONS'])
 def pdf_options(project_id):
@@ -56,33 +75,9 @@ def pdf_options(project_id):
 @jwt_required()
 def export_pdf(project_id):
     """Export PDF report"""
-    try:
-        project = Project.query.get(project_id)
-        if not project:
-            return jsonify({'error': 'Project not found'}), 404
-        
-        penetrations = Penetration.query.filter_by(project_id=project_id).all()
-        
-        if not penetrations:
-            return jsonify({'error': 'No penetrations found for this project'}), 404
-        
-        # Generate PDF report
-        pdf_buffer = generate_penetration_report(project, penetrations)
-        
-        # Create filename
-        filename = f"PenLog_{project.ship_name.replace(' ', '_')}_{datetime.now().strftime('%Y%m%d')}_Report.pdf"
-        
-        return send_file(
-            pdf_buffer,
-            mimetype='application/pdf',
-            as_attachment=True,
-            download_name=filename
-        )
-        
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+    from utils.pdf_generator import generate_penetration_report
+    
+    return run_export(project_id, generate_penetration_report, '_Report.pdf', 'application/pdf', with_photos=True)
 
 # Keep the old endpoint for backward compatibility
 @pdf_bp.route('/project/<int:project_id>/complete', methods=['OPTIONS'])
@@ -93,34 +88,87 @@ def complete_options(project_id):
 @pdf_bp.route('/project/<int:project_id>/complete', methods=['GET'])
 @jwt_required()
 def export_complete_package(project_id):
-    """Export complete package: Excel with Cloudinary photo links"""
+    """Export complete package: Excel with Cloudinary photo links (?async=true queues a job)"""
+    # Large projects: build the file on the background pool and let the client poll.
+    # Without a shared cache the job couldn't be polled reliably, so build it inline.
+    if request.args.get('async', 'false').lower() == 'true' and export_jobs_available():
+        return queue_complete_package(project_id)
+    
+    from utils.package_generator import generate_complete_package
+    
+    # Upload folder is not used for Cloudinary but kept for backward compatibility
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    
+    return run_export(
+        project_id,
+        lambda project, penetrations, output: generate_complete_package(project, penetrations, upload_folder, output=output),
+        '_Complete.xlsx',
+        XLSX_MIMETYPE,
+        with_photos=True
+    )
+
+def queue_complete_package(project_id):
+    """Start a background complete package export and return its job handle"""
     try:
-        project = Project.query.get(project_id)
+        project = db.session.get(Project, project_id)
         if not project:
             return jsonify({'error': 'Project not found'}), 404
         
-        penetrations = Penetration.query.filter_by(project_id=project_id).all()
-        
-        if not penetrations:
+        # Nothing is loaded here, so probe with EXISTS rather than fetching the pens
+        if not db.session.query(Penetration.query.filter_by(project_id=project_id).exists()).scalar():
             return jsonify({'error': 'No penetrations found for this project'}), 404
         
-        # Get upload folder from config (not used for Cloudinary but kept for backward compatibility)
-        upload_folder = current_app.config['UPLOAD_FOLDER']
+        job_id = start_complete_package_export(project_id, export_filename(project, '_Complete.xlsx'))
+        return jsonify({
+            'job_id': job_id,
+            'status_url': url_for('pdf.get_export_job_status', job_id=job_id)
+        }), 202
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@pdf_bp.route('/job/<job_id>', methods=['GET'])
+@jwt_required()
+def get_export_job_status(job_id):
+    """Get the status of a background export job"""
+    try:
+        job = get_export_job(job_id)
+        if not job:
+            return jsonify({'error': 'Export job not found'}), 404
+        
+        response = {'job_id': job_id, **job}
+        response.pop('host', None)
+        if job['status'] == 'finished':
+            response['download_url'] = url_for('pdf.download_export_job', job_id=job_id)
+        
+        return jsonify(response), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@pdf_bp.route('/job/<job_id>/download', methods=['GET'])
+@jwt_required()
+def download_export_job(job_id):
+    """Download the file produced by a finished export job"""
+    try:
+        job = get_export_job(job_id)
+        if not job or job['status'] != 'finished':
+            return jsonify({'error': 'Export not ready'}), 404
         
-        # Generate complete package (returns Excel with Cloudinary links)
-        excel_buffer = generate_complete_package(project, penetrations, upload_folder)
+        # The file is on the host that built it (see services.exports.EXPORT_HOST)
+        if not export_job_is_local(job):
+            return jsonify({'error': 'Export was built on another server; request it again without async=true'}), 409
         
-        # Create filename
-        filename = f"PenLog_{project.ship_name.replace(' ', '_')}_{datetime.now().strftime('%Y%m%d')}_Complete.xlsx"
+        path = export_job_path(job_id)
+        if not os.path.exists(path):
+            return jsonify({'error': 'Export file has expired'}), 404
         
         return send_file(
-            excel_buffer,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            path,
+            mimetype=XLSX_MIMETYPE,
             as_attachment=True,
-            download_name=filename
+            download_name=job['filename']
         )
         
     except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
\ No newline at end of file
+        return jsonify({'error': str(e)}), 500
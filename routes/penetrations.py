@@ -1,13 +1,41 @@
-from flask import Blueprint, request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt_identity
+from flask import Blueprint, request, jsonify, g
+from flask_jwt_extended import jwt_required
+from sqlalchemy import insert, delete
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import joinedload, selectinload
 from datetime import datetime  # ADD THIS
-from app import db
-from models import Penetration, PenActivity, User, Project  # ADD Project
+import traceback
+from app import db, cache
+from models import Penetration, PenActivity, Photo, Project  # ADD Project
+from utils.auth import load_identity
+from utils.cache import cache_version, bump_cache_version, cacheable_response
+from utils.responses import json_response, json_array_response, conditional
+from services.uploads import delete_cloudinary_photos
 
 penetrations_bp = Blueprint('penetrations', __name__)
 
+VALID_STATUSES = frozenset({'not_started', 'open', 'closed', 'verified'})
+COMPLETED_STATUSES = frozenset({'closed', 'verified'})
+
+# Payload shape for creating/importing penetrations: required keys are checked with one
+# set comparison and optional columns are copied in a single comprehension
+REQUIRED_FIELDS = frozenset({'project_id', 'pen_id', 'deck'})
+OPTIONAL_FIELDS = ('fire_zone', 'frame', 'location', 'pen_type', 'size')
+# Fields update_penetration copies as-is (status is validated separately)
+UPDATABLE_FIELDS = ('deck', 'location', 'pen_id', 'status', 'diameter', 'notes', 'contractor_id')
+
+# Rows per bulk_import INSERT statement, bounding parameter and RETURNING buffers per round-trip
+IMPORT_CHUNK_SIZE = 1000
+
+def penetrations_cache_key(*args, **kwargs):
+    """Cache penetration lists per filter set until penetrations, photos or contractors change"""
+    filters = sorted(request.args.items())
+    return f"penetrations:{cache_version('penetrations')}:{cache_version('contractors')}:{filters}"
+
 @penetrations_bp.route('/', methods=['GET'])
 @jwt_required()
+@conditional
+@cache.cached(timeout=30, make_cache_key=penetrations_cache_key, response_filter=cacheable_response)
 def get_penetrations():
     """Get all penetrations with optional filtering"""
     try:
@@ -18,8 +46,8 @@ def get_penetrations():
         deck = request.args.get('deck')
         priority = request.args.get('priority')
         
-        # Build query
-        query = Penetration.query
+        # Build query - contractor_name is part of to_dict(), so load contractors in the same query
+        query = Penetration.query.options(joinedload(Penetration.contractor))
         
         # Project filter is required for most queries
         if project_id:
@@ -36,23 +64,27 @@ def get_penetrations():
         
         penetrations = query.all()
         
+        # Count photos for all pens in one query instead of one per pen
+        photo_counts = Penetration.photo_counts([pen.id for pen in penetrations])
+        
         # Serialize each pen individually to catch errors
-        result = []
-        for pen in penetrations:
+        def serialize(pen):
             try:
-                result.append(pen.to_dict())
+                return pen.to_dict(photo_count=photo_counts.get(pen.id, 0))
             except Exception as pen_error:
                 print(f"ERROR serializing pen {pen.id}: {str(pen_error)}")
-                import traceback
                 traceback.print_exc()
                 # Re-raise to see full error
                 raise
         
-        return jsonify(result), 200
+        # Encoded pen by pen rather than building a list of dicts first.
+        # The ETag is cached with the response; @conditional turns matching polls into 304s
+        response = json_array_response(penetrations, serialize)
+        response.add_etag()
+        return response
         
     except Exception as e:
         print(f"MAIN ERROR in get_penetrations: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
@@ -61,11 +93,20 @@ def get_penetrations():
 def get_penetration(pen_id):
     """Get single penetration with activities and photos"""
     try:
-        penetration = Penetration.query.get(pen_id)
+        penetration = Penetration.query.options(
+            joinedload(Penetration.contractor),
+            selectinload(Penetration.activities).joinedload(PenActivity.user),
+            # Photos still uploading in the background have no URL yet
+            selectinload(Penetration.photos.and_(Photo.upload_status == 'uploaded')).joinedload(Photo.user)
+        ).filter_by(id=pen_id).first()
         if not penetration:
             return jsonify({'error': 'Penetration not found'}), 404
         
-        return jsonify(penetration.to_dict(include_activities=True, include_photos=True)), 200
+        return jsonify(penetration.to_dict(
+            include_activities=True,
+            include_photos=True,
+            photo_count=len(penetration.photos)
+        )), 200
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -75,17 +116,15 @@ def get_penetration(pen_id):
 def create_penetration():
     """Create new penetration (supervisor only)"""
     try:
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
+        load_identity()
         
-        if current_user.role != 'supervisor' and current_user.role != 'admin':
+        if g.claims.get('role') not in ('supervisor', 'admin'):
             return jsonify({'error': 'Unauthorized'}), 403
         
         data = request.get_json()
         
         # Validate required fields
-        required_fields = ['project_id', 'pen_id', 'deck']
-        if not all(field in data for field in required_fields):
+        if not data.keys() >= REQUIRED_FIELDS:
             return jsonify({'error': 'Missing required fields'}), 400
         
         # Check if pen_id already exists for this contractor in this project
@@ -103,11 +142,7 @@ def create_penetration():
             project_id=data['project_id'],
             pen_id=data['pen_id'],
             deck=data['deck'],
-            fire_zone=data.get('fire_zone'),
-            frame=data.get('frame'),
-            location=data.get('location'),
-            pen_type=data.get('pen_type'),
-            size=data.get('size'),
+            **{field: data.get(field) for field in OPTIONAL_FIELDS},
             # This handles both missing keys AND empty strings:
             contractor_id=data.get('contractor_id') or None, 
             priority=data.get('priority', 'routine'),
@@ -116,6 +151,7 @@ def create_penetration():
         
         db.session.add(penetration)
         db.session.commit()
+        bump_cache_version('penetrations')
         
         return jsonify({
             'message': 'Penetration created successfully',
@@ -132,14 +168,7 @@ def create_penetration():
 def update_status(pen_id):
     """Update penetration status and log activity"""
     try:
-        from datetime import datetime
-        
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
-        
-        penetration = Penetration.query.get(pen_id)
-        if not penetration:
-            return jsonify({'error': 'Penetration not found'}), 404
+        load_identity()
         
         data = request.get_json()
         new_status = data.get('status')
@@ -148,13 +177,29 @@ def update_status(pen_id):
         if not new_status:
             return jsonify({'error': 'Status required'}), 400
         
-        valid_statuses = ['not_started', 'open', 'closed', 'verified']
-        if new_status not in valid_statuses:
+        if new_status not in VALID_STATUSES:
             return jsonify({'error': 'Invalid status'}), 400
         
+        # Check authorization for status changes before taking any row lock or
+        # counting photos, so other callers can't block the pen or probe it
+        if g.claims.get('role') == 'contractor':
+            if new_status == 'verified':
+                return jsonify({'error': 'Only supervisors can verify'}), 403
+            # Contractors can only open/close their own penetrations
+            assigned_contractor = db.session.scalar(
+                db.select(Penetration.contractor_id).filter_by(id=pen_id)
+            )
+            if assigned_contractor != g.claims.get('contractor_id'):
+                return jsonify({'error': 'Unauthorized'}), 403
+        
+        # Lock the row so concurrent status changes serialize instead of logging stale transitions
+        penetration = db.session.get(Penetration, pen_id, with_for_update=True)
+        if not penetration:
+            return jsonify({'error': 'Penetration not found'}), 404
+        
         # Validate photo count when closing
         if new_status == 'closed':
-            photo_count = penetration.photos.count()
+            photo_count = Penetration.photo_count_upto(pen_id, 2)
             if photo_count < 2:
                 return jsonify({
                     'error': f'Cannot close: Only {photo_count} photo(s) attached. Minimum 2 photos required.',
@@ -162,25 +207,18 @@ def update_status(pen_id):
                     'requires_photos': True
                 }), 400
         
-        # Check authorization for status changes
-        if current_user.role == 'contractor':
-            # Contractors can only open/close their own penetrations
-            if penetration.contractor_id != current_user.contractor_id:
-                return jsonify({'error': 'Unauthorized'}), 403
-            if new_status == 'verified':
-                return jsonify({'error': 'Only supervisors can verify'}), 403
-        
         previous_status = penetration.status
         
-        # Log activity (even if status unchanged, to record notes)
-        activity = PenActivity(
+        # Log activity (even if status unchanged, to record notes) with a direct
+        # INSERT ... RETURNING rather than a unit-of-work flush
+        activity = db.session.scalars(insert(PenActivity).returning(PenActivity), [dict(
             penetration_id=pen_id,
-            user_id=user_id,
+            user_id=g.user_id,
             action=f"status_changed" if new_status != previous_status else "note_added",
             previous_status=previous_status,
             new_status=new_status,
             notes=notes
-        )
+        )]).one()
         
         # Update status
         penetration.status = new_status
@@ -188,11 +226,11 @@ def update_status(pen_id):
         # Automatically set timestamps based on status
         if new_status == 'open' and not penetration.opened_at:
             penetration.opened_at = datetime.utcnow()
-        elif new_status in ['closed', 'verified'] and not penetration.completed_at:
+        elif new_status in COMPLETED_STATUSES and not penetration.completed_at:
             penetration.completed_at = datetime.utcnow()
         
         # If going back to open from closed, clear completed_at
-        if new_status == 'open' and previous_status in ['closed', 'verified']:
+        if new_status == 'open' and previous_status in COMPLETED_STATUSES:
             penetration.completed_at = None
         
         # If going back to not_started, clear both timestamps
@@ -200,8 +238,8 @@ def update_status(pen_id):
             penetration.opened_at = None
             penetration.completed_at = None
         
-        db.session.add(activity)
         db.session.commit()
+        bump_cache_version('penetrations')
         
         return jsonify({
             'message': 'Status updated successfully',
@@ -218,14 +256,18 @@ def update_status(pen_id):
 def get_activities(pen_id):
     """Get all activities for a penetration"""
     try:
-        penetration = Penetration.query.get(pen_id)
+        penetration = db.session.get(Penetration, pen_id)
         if not penetration:
             return jsonify({'error': 'Penetration not found'}), 404
         
-        activities = PenActivity.query.filter_by(penetration_id=pen_id)\
-            .order_by(PenActivity.timestamp.desc()).all()
+        # Usernames come from the same query (outer join) rather than a lazy load per activity
+        activities = db.session.execute(
+            PenActivity.feed_select().filter(
+                PenActivity.penetration_id == pen_id
+            ).order_by(PenActivity.timestamp.desc())
+        ).all()
         
-        return jsonify([activity.to_dict() for activity in activities]), 200
+        return json_response([PenActivity.feed_dict(row) for row in activities])
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -235,10 +277,9 @@ def get_activities(pen_id):
 def bulk_import():
     """Bulk import penetrations from spreadsheet (supervisor only)"""
     try:
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
+        load_identity()
         
-        if current_user.role != 'supervisor':
+        if g.claims.get('role') != 'supervisor':
             return jsonify({'error': 'Unauthorized'}), 403
         
         data = request.get_json()
@@ -252,47 +293,59 @@ def bulk_import():
             return jsonify({'error': 'No penetrations provided'}), 400
         
         # Verify project exists
-        from models import Project
-        project = Project.query.get(project_id)
+        project = db.session.get(Project, project_id)
         if not project:
             return jsonify({'error': 'Project not found'}), 404
         
+        # Existing pen IDs for the project in one query instead of one lookup per row
+        existing_ids = set(db.session.scalars(
+            db.select(Penetration.pen_id).filter_by(project_id=project_id)
+        ))
+        
         created = []
         errors = []
+        rows = []
         
         for pen_data in penetrations_data:
             try:
-                # Check if already exists in this project
-                existing = Penetration.query.filter_by(
-                    project_id=project_id,
-                    pen_id=pen_data['pen_id']
-                ).first()
-                
-                if existing:
-                    errors.append(f"{pen_data['pen_id']}: Already exists in this project")
+                # pen_id is a String column; spreadsheets often send numeric ids (101)
+                pen_id = str(pen_data['pen_id'])
+                if pen_id in existing_ids:
+                    errors.append(f"{pen_id}: Already exists in this project")
                     continue
                 
-                penetration = Penetration(
+                rows.append(dict(
                     project_id=project_id,
-                    pen_id=pen_data['pen_id'],
+                    pen_id=pen_id,
                     deck=pen_data['deck'],
-                    fire_zone=pen_data.get('fire_zone'),
-                    frame=pen_data.get('frame'),
-                    location=pen_data.get('location'),
-                    pen_type=pen_data.get('pen_type'),
-                    size=pen_data.get('size'),
+                    **{field: pen_data.get(field) for field in OPTIONAL_FIELDS},
                     contractor_id=pen_data.get('contractor_id'),
                     priority=pen_data.get('priority', 'routine'),
                     status=pen_data.get('status', 'not_started')
-                )
-                
-                db.session.add(penetration)
-                created.append(pen_data['pen_id'])
+                ))
+                existing_ids.add(pen_id)  # Repeats later in the same sheet are duplicates too
                 
             except Exception as e:
                 errors.append(f"{pen_data.get('pen_id', 'unknown')}: {str(e)}")
         
+        # Executemany INSERTs (batched into multi-row VALUES) of up to IMPORT_CHUNK_SIZE pens,
+        # all in the request's single transaction. Rows that hit the unique constraint (e.g. a
+        # concurrent import) are skipped by the database rather than failing the batch;
+        # RETURNING reports which pens were actually created.
+        stmt = pg_insert(Penetration).on_conflict_do_nothing(
+            index_elements=['project_id', 'contractor_id', 'pen_id']
+        ).returning(Penetration.pen_id)
+        for start in range(0, len(rows), IMPORT_CHUNK_SIZE):
+            created.extend(db.session.scalars(stmt, rows[start:start + IMPORT_CHUNK_SIZE]))
+        
+        inserted = set(created)
+        errors.extend(
+            f"{row['pen_id']}: Already exists in this project"
+            for row in rows if row['pen_id'] not in inserted
+        )
+        
         db.session.commit()
+        bump_cache_version('penetrations')
         
         return jsonify({
             'message': f'Imported {len(created)} penetrations',
@@ -309,48 +362,36 @@ def bulk_import():
 def update_penetration(pen_id):
     """Update a penetration (admin or supervisor of project only)"""
     try:
-        user_id = int(get_jwt_identity())  # Get user ID
-        user = User.query.get(user_id)  # Query by ID, not username
-        
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
+        # Reject other roles from the token claims before touching the database
+        load_identity()
+        role = g.claims.get('role')
+        if role not in ('supervisor', 'admin'):
+            return jsonify({'error': 'Not authorized'}), 403
         
-        pen = Penetration.query.get(pen_id)
+        pen = db.session.get(Penetration, pen_id)
         if not pen:
             return jsonify({'error': 'Penetration not found'}), 404
         
         # Authorization check
-        if user.role == 'supervisor':
+        if role == 'supervisor':
             # Supervisors can only edit pens in their assigned projects
-            project = Project.query.get(pen.project_id)
-            if not project or project.supervisor_id != user.id:
+            project = db.session.get(Project, pen.project_id)
+            if not project or project.supervisor_id != g.user_id:
                 return jsonify({'error': 'Not authorized to edit this penetration'}), 403
-        elif user.role != 'admin':
-            return jsonify({'error': 'Not authorized'}), 403
         
         # Get update data
         data = request.get_json()
         
+        if 'status' in data and data['status'] not in VALID_STATUSES:
+            return jsonify({'error': 'Invalid status'}), 400
+        
         # Update fields
-        if 'deck' in data:
-            pen.deck = data['deck']
-        if 'location' in data:
-            pen.location = data['location']
-        if 'pen_id' in data:
-            pen.pen_id = data['pen_id']
-        if 'status' in data:
-            if data['status'] not in ['not_started', 'open', 'closed', 'verified']:
-                return jsonify({'error': 'Invalid status'}), 400
-            pen.status = data['status']
-        if 'diameter' in data:
-            pen.diameter = data['diameter']
-        if 'notes' in data:
-            pen.notes = data['notes']
-        if 'contractor_id' in data:
-            pen.contractor_id = data['contractor_id']
-        
-        pen.updated_at = datetime.utcnow()
+        for field in UPDATABLE_FIELDS:
+            if field in data:
+                setattr(pen, field, data[field])
+        
         db.session.commit()
+        bump_cache_version('penetrations')
         
         return jsonify({
             'message': 'Penetration updated successfully',
@@ -367,32 +408,33 @@ def update_penetration(pen_id):
 def delete_penetration(pen_id):
     """Delete a penetration (admin or supervisor of project only)"""
     try:
-        user_id = int(get_jwt_identity())  # Get user ID
-        user = User.query.get(user_id)  # Query by ID, not username
-        
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
+        # Reject other roles from the token claims before touching the database
+        load_identity()
+        role = g.claims.get('role')
+        if role not in ('supervisor', 'admin'):
+            return jsonify({'error': 'Not authorized'}), 403
         
-        pen = Penetration.query.get(pen_id)
+        pen = db.session.get(Penetration, pen_id)
         if not pen:
             return jsonify({'error': 'Penetration not found'}), 404
         
         # Authorization check
-        if user.role == 'supervisor':
+        if role == 'supervisor':
             # Supervisors can only delete pens in their assigned projects
-            project = Project.query.get(pen.project_id)
-            if not project or project.supervisor_id != user.id:
+            project = db.session.get(Project, pen.project_id)
+            if not project or project.supervisor_id != g.user_id:
                 return jsonify({'error': 'Not authorized to delete this penetration'}), 403
-        elif user.role != 'admin':
-            return jsonify({'error': 'Not authorized'}), 403
         
-        # Delete associated photos first (cascade delete)
-        from models import Photo
-        Photo.query.filter_by(penetration_id=pen_id).delete()
+        # Delete associated photos first (cascade delete), keeping their Cloudinary ids
+        public_ids = db.session.scalars(
+            delete(Photo).where(Photo.penetration_id == pen_id).returning(Photo.cloudinary_public_id)
+        ).all()
         
         # Hard delete the penetration
         db.session.delete(pen)
         db.session.commit()
+        bump_cache_version('penetrations')
+        delete_cloudinary_photos(public_ids)
         
         return jsonify({'message': 'Penetration deleted successfully'}), 200
         
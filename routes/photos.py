@@ -1,14 +1,16 @@
-from flask import Blueprint, request, jsonify, redirect
+from flask import Blueprint, request, jsonify, g, redirect
 from flask_jwt_extended import jwt_required, get_jwt_identity
 import cloudinary
 import cloudinary.uploader
 import cloudinary.api
-from werkzeug.utils import secure_filename
+from sqlalchemy.orm import joinedload
 import os
 from app import db
-from models import Photo, Penetration, User
+from models import Photo, Penetration
 from models import ContractorAccessToken  # Add this import at top
-from datetime import datetime
+from utils.auth import load_identity
+from utils.cache import bump_cache_version
+from services.uploads import save_penetration_photo, contractor_access_check, photo_delivery_url
 
 photos_bp = Blueprint('photos', __name__)
 
@@ -20,70 +22,20 @@ cloudinary.config(
     secure=True
 )
 
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'heic'}
-
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+# Clients should use the Cloudinary URL in photo payloads ('filepath') directly;
+# GET /<photo_id> remains for older clients and shared links
+PHOTO_REDIRECT_MAX_AGE = 24 * 60 * 60
 
 @photos_bp.route('/upload', methods=['POST'])
 @jwt_required()
 def upload_photo():
     """Upload photo to Cloudinary and create database record"""
     try:
-        user_id = int(get_jwt_identity())
-        
-        if 'file' not in request.files:
-            return jsonify({'error': 'No file provided'}), 400
-        
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({'error': 'No file selected'}), 400
-        
-        if not allowed_file(file.filename):
-            return jsonify({'error': 'Invalid file type. Allowed: png, jpg, jpeg, gif, heic'}), 400
-        
-        penetration_id = request.form.get('penetration_id')
-        if not penetration_id:
-            return jsonify({'error': 'Penetration ID required'}), 400
-        
-        penetration = Penetration.query.get(penetration_id)
-        if not penetration:
-            return jsonify({'error': 'Penetration not found'}), 404
-        
-        photo_type = request.form.get('photo_type', 'general')
-        caption = request.form.get('caption')
-        
-        # Upload to Cloudinary
-        # Organize by penetration ID for better management
-        upload_result = cloudinary.uploader.upload(
-            file,
-            folder=f"penlog/pen_{penetration_id}",
-            resource_type="image",
-            transformation=[
-                {'width': 1920, 'height': 1080, 'crop': 'limit'},  # Max size
-                {'quality': 'auto:good'}  # Auto optimize quality
-            ]
-        )
-        
-        # Create database record
-        photo = Photo(
-            penetration_id=penetration_id,
-            user_id=user_id,
-            filename=secure_filename(file.filename),
-            filepath=upload_result['secure_url'],  # Store Cloudinary URL
-            cloudinary_public_id=upload_result['public_id'],  # For deletion
-            caption=caption,
-            photo_type=photo_type
+        return save_penetration_photo(
+            user_id=int(get_jwt_identity()),
+            queue=request.args.get('async', 'false').lower() == 'true'  # ?async=true: 202 + status_url
         )
         
-        db.session.add(photo)
-        db.session.commit()
-        
-        return jsonify({
-            'message': 'Photo uploaded successfully',
-            'photo': photo.to_dict()
-        }), 201
-        
     except Exception as e:
         db.session.rollback()
         print(f"Photo upload error: {str(e)}")
@@ -102,64 +54,7 @@ def upload_photo_via_magic_link(token):
         if not access_token.is_valid():
             return jsonify({'error': 'Access link has expired or been revoked'}), 403
         
-        if 'file' not in request.files:
-            return jsonify({'error': 'No file provided'}), 400
-        
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({'error': 'No file selected'}), 400
-        
-        if not allowed_file(file.filename):
-            return jsonify({'error': 'Invalid file type. Allowed: png, jpg, jpeg, gif, heic'}), 400
-        
-        penetration_id = request.form.get('penetration_id')
-        if not penetration_id:
-            return jsonify({'error': 'Penetration ID required'}), 400
-        
-        penetration = Penetration.query.get(penetration_id)
-        if not penetration:
-            return jsonify({'error': 'Penetration not found'}), 404
-        
-        # Verify this contractor is assigned to this pen
-        if penetration.contractor_id != access_token.contractor_id:
-            return jsonify({'error': 'You are not assigned to this penetration'}), 403
-        
-        photo_type = request.form.get('photo_type', 'general')
-        caption = request.form.get('caption')
-        
-        # Upload to Cloudinary
-        upload_result = cloudinary.uploader.upload(
-            file,
-            folder=f"penlog/pen_{penetration_id}",
-            resource_type="image",
-            transformation=[
-                {'width': 1920, 'height': 1080, 'crop': 'limit'},
-                {'quality': 'auto:good'}
-            ]
-        )
-        
-        # Create database record (no user_id since this is magic link access)
-        photo = Photo(
-            penetration_id=penetration_id,
-            user_id=None,  # No user for magic link uploads
-            filename=secure_filename(file.filename),
-            filepath=upload_result['secure_url'],
-            cloudinary_public_id=upload_result['public_id'],
-            caption=caption,
-            photo_type=photo_type
-        )
-        
-        db.session.add(photo)
-        
-        # Update last used timestamp
-        access_token.last_used_at = datetime.utcnow()
-        
-        db.session.commit()
-        
-        return jsonify({
-            'message': 'Photo uploaded successfully',
-            'photo': photo.to_dict()
-        }), 201
+        return save_penetration_photo(contractor_access_check(access_token))
         
     except Exception as e:
         db.session.rollback()
@@ -171,7 +66,7 @@ def upload_photo_via_magic_link(token):
 def get_photo_info(photo_id):
     """Get photo metadata"""
     try:
-        photo = Photo.query.get(photo_id)
+        photo = db.session.get(Photo, photo_id)
         if not photo:
             return jsonify({'error': 'Photo not found'}), 404
         
@@ -184,12 +79,19 @@ def get_photo_info(photo_id):
 def get_photo(photo_id):
     """Redirect to Cloudinary URL - public endpoint"""
     try:
-        photo = Photo.query.get(photo_id)
+        photo = db.session.get(Photo, photo_id)
         if not photo:
             return jsonify({'error': 'Photo not found'}), 404
         
-        # Redirect to Cloudinary URL
-        return redirect(photo.filepath)
+        # No URL to redirect to until a background upload finishes; don't let that be cached
+        if photo.upload_status != 'uploaded':
+            return jsonify({'error': 'Photo is still uploading'}), 409, {'Cache-Control': 'no-store', 'Retry-After': '5'}
+        
+        # Redirect to Cloudinary URL. A photo's URL never changes, so let browsers and
+        # CDNs reuse the redirect for a day instead of asking us on every image load
+        response = redirect(photo_delivery_url(photo))
+        response.headers['Cache-Control'] = f'public, max-age={PHOTO_REDIRECT_MAX_AGE}'
+        return response
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -199,15 +101,15 @@ def get_photo(photo_id):
 def delete_photo(photo_id):
     """Delete photo from Cloudinary and database"""
     try:
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
+        load_identity()
+        user_id = g.user_id
         
-        photo = Photo.query.get(photo_id)
+        photo = db.session.get(Photo, photo_id)
         if not photo:
             return jsonify({'error': 'Photo not found'}), 404
         
         # Only photo uploader or supervisor/admin can delete
-        if photo.user_id != user_id and current_user.role not in ['supervisor', 'admin']:
+        if photo.user_id != user_id and g.claims.get('role') not in ['supervisor', 'admin']:
             return jsonify({'error': 'Unauthorized'}), 403
         
         # Delete from Cloudinary
@@ -221,6 +123,7 @@ def delete_photo(photo_id):
         # Delete database record
         db.session.delete(photo)
         db.session.commit()
+        bump_cache_version('penetrations')  # photo_count is part of penetration payloads
         
         return jsonify({'message': 'Photo deleted successfully'}), 200
         
@@ -233,11 +136,14 @@ def delete_photo(photo_id):
 def get_penetration_photos(penetration_id):
     """Get all photos for a penetration"""
     try:
-        penetration = Penetration.query.get(penetration_id)
+        penetration = db.session.get(Penetration, penetration_id)
         if not penetration:
             return jsonify({'error': 'Penetration not found'}), 404
         
-        photos = Photo.query.filter_by(penetration_id=penetration_id)\
+        # to_dict() reads photo.user; load uploaders in the same query instead of one per photo.
+        # Photos still uploading in the background are left out until they have a URL.
+        photos = Photo.query.options(joinedload(Photo.user))\
+            .filter_by(penetration_id=penetration_id, upload_status='uploaded')\
             .order_by(Photo.uploaded_at.desc()).all()
         
         return jsonify([photo.to_dict() for photo in photos]), 200
@@ -1,39 +1,57 @@
-from flask import Blueprint, request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt_identity
+from flask import Blueprint, request, jsonify, g
+from flask_jwt_extended import jwt_required
 from datetime import datetime
-from app import db
-from models import Project, User
-from sqlalchemy import func, case
+from app import db, cache
+from models import Project, Penetration, Contractor, Photo, User
+from utils.auth import load_identity
+from utils.cache import cache_version, bump_cache_version, cacheable_response
+from utils.responses import json_array_response
+from services.uploads import delete_cloudinary_photos
+from routes.dashboard import STATUSES, status_count_columns
+from sqlalchemy import select, func, case
 
 projects_bp = Blueprint('projects', __name__)
 
+# The fields of Project.to_dict(), selected as plain rows so listing projects builds
+# no ORM instances; orjson writes the dates and timestamps as ISO 8601 like to_dict()
+PROJECT_COLUMNS = (
+    Project.id, Project.name, Project.ship_name, Project.drydock_location,
+    Project.start_date, Project.embarkation_date, Project.status, Project.notes,
+    Project.supervisor_id, Project.invite_code, Project.created_at, Project.updated_at
+)
+
 @projects_bp.route('/', methods=['GET'])
 @jwt_required()
 def get_projects():
     """Get all projects"""
     try:
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
+        load_identity()
+        user_id = g.user_id
         
         status = request.args.get('status')
         include_stats = request.args.get('include_stats', 'false').lower() == 'true'
         
-        query = Project.query
+        query = select(*PROJECT_COLUMNS)
         
         # Filter by supervisor - admins see all, supervisors see only their projects
-        if current_user.role == 'admin':
+        if g.claims.get('role') == 'admin':
             # Admin sees all projects
             pass
         else:
             # Supervisors see only their assigned projects
-            query = query.filter_by(supervisor_id=user_id)
+            query = query.where(Project.supervisor_id == user_id)
         
         if status:
-            query = query.filter_by(status=status)
+            query = query.where(Project.status == status)
+        
+        projects = db.session.execute(query.order_by(Project.start_date.desc())).mappings().all()
         
-        projects = query.order_by(Project.start_date.desc()).all()
+        # Aggregate stats for every project in one query instead of 5 per project
+        if include_stats:
+            stats = Project.penetration_stats([p['id'] for p in projects])
+            return json_array_response(projects, lambda p: {**p, 'stats': stats[p['id']]})
         
-        return jsonify([p.to_dict(include_stats=include_stats) for p in projects]), 200
+        return json_array_response(projects, dict)
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -43,15 +61,15 @@ def get_projects():
 def get_project(project_id):
     """Get single project with stats"""
     try:
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
+        load_identity()
+        user_id = g.user_id
         
-        project = Project.query.get(project_id)
+        project = db.session.get(Project, project_id)
         if not project:
             return jsonify({'error': 'Project not found'}), 404
         
         # Check if user has access to this project
-        if current_user.username != 'admin' and project.supervisor_id != user_id:
+        if g.claims.get('username') != 'admin' and project.supervisor_id != user_id:
             return jsonify({'error': 'Unauthorized - You are not assigned to this project'}), 403
         
         return jsonify(project.to_dict(include_stats=True)), 200
@@ -64,10 +82,10 @@ def get_project(project_id):
 def create_project():
     """Create new project (supervisor only)"""
     try:
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
+        load_identity()
+        user_id = g.user_id
         
-        if current_user.role != 'supervisor' and current_user.role != 'admin':  # Also allow admin
+        if g.claims.get('role') not in ['supervisor', 'admin']:  # Also allow admin
             return jsonify({'error': 'Unauthorized'}), 403
         
         data = request.get_json()
@@ -112,13 +130,12 @@ def create_project():
 def update_project(project_id):
     """Update project (supervisor or admin only)"""
     try:
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
+        load_identity()
         
-        if current_user.role not in ['supervisor', 'admin']:
+        if g.claims.get('role') not in ['supervisor', 'admin']:
             return jsonify({'error': 'Unauthorized'}), 403
         
-        project = Project.query.get(project_id)
+        project = db.session.get(Project, project_id)
         if not project:
             return jsonify({'error': 'Project not found'}), 404
         
@@ -150,6 +167,7 @@ def update_project(project_id):
         project_dict = project.to_dict()
         
         db.session.commit()
+        bump_cache_version('projects')
         
         return jsonify({
             'message': 'Project updated successfully',
@@ -165,18 +183,27 @@ def update_project(project_id):
 def delete_project(project_id):
     """Delete project (supervisor or admin only) - WARNING: Deletes all penetrations"""
     try:
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
+        load_identity()
         
-        if current_user.role not in ['supervisor', 'admin']:
+        if g.claims.get('role') not in ['supervisor', 'admin']:
             return jsonify({'error': 'Unauthorized'}), 403
         
-        project = Project.query.get(project_id)
+        project = db.session.get(Project, project_id)
         if not project:
             return jsonify({'error': 'Project not found'}), 404
         
+        # Photo assets to remove from Cloudinary once the rows are gone
+        public_ids = db.session.scalars(
+            select(Photo.cloudinary_public_id)
+            .join(Penetration, Photo.penetration_id == Penetration.id)
+            .where(Penetration.project_id == project_id)
+        ).all()
+        
         db.session.delete(project)
         db.session.commit()
+        bump_cache_version('penetrations')
+        bump_cache_version('projects')
+        delete_cloudinary_photos(public_ids)
         
         return jsonify({'message': 'Project deleted successfully'}), 200
         
@@ -189,14 +216,13 @@ def delete_project(project_id):
 def assign_supervisor(project_id):
     """Assign a supervisor to a project (admin only)"""
     try:
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
+        load_identity()
         
         # Only admin can assign supervisors
-        if current_user.username != 'admin':
+        if g.claims.get('username') != 'admin':
             return jsonify({'error': 'Unauthorized - Admin only'}), 403
         
-        project = Project.query.get(project_id)
+        project = db.session.get(Project, project_id)
         if not project:
             return jsonify({'error': 'Project not found'}), 404
         
@@ -207,7 +233,7 @@ def assign_supervisor(project_id):
             return jsonify({'error': 'supervisor_id is required'}), 400
         
         # Verify supervisor exists and is a supervisor role
-        supervisor = User.query.get(supervisor_id)
+        supervisor = db.session.get(User, supervisor_id)
         if not supervisor:
             return jsonify({'error': 'Supervisor user not found'}), 404
         
@@ -217,6 +243,7 @@ def assign_supervisor(project_id):
         # Assign supervisor
         project.supervisor_id = supervisor_id
         db.session.commit()
+        bump_cache_version('projects')
         
         return jsonify({
             'message': 'Supervisor assigned successfully',
@@ -232,11 +259,10 @@ def assign_supervisor(project_id):
 def get_supervisors():
     """Get all supervisor users (admin only)"""
     try:
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
+        load_identity()
         
         # Only admin can see all supervisors
-        if current_user.username != 'admin':
+        if g.claims.get('username') != 'admin':
             return jsonify({'error': 'Unauthorized - Admin only'}), 403
         
         supervisors = User.query.filter_by(role='supervisor').all()
@@ -261,35 +287,62 @@ def get_supervisors():
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+def project_dashboard_cache_key(*args, **kwargs):
+    """Cache a project's dashboard until its project row, penetrations/photos or contractors change"""
+    return (
+        f"project_dashboard:{cache_version('projects')}:{cache_version('penetrations')}:"
+        f"{cache_version('contractors')}:{kwargs['project_id']}"
+    )
+
 @projects_bp.route('/<int:project_id>/dashboard', methods=['GET'])
 @jwt_required()
+@cache.cached(timeout=60, make_cache_key=project_dashboard_cache_key, response_filter=cacheable_response)
 def get_project_dashboard(project_id):
     """Get comprehensive dashboard data for a project"""
     try:
-        from sqlalchemy import func
-        from models import Penetration, Contractor
-        
-        project = Project.query.get(project_id)
+        project = db.session.get(Project, project_id)
         if not project:
             return jsonify({'error': 'Project not found'}), 404
         
-        # Overall stats
-        total = project.penetrations.count()
-        not_started = project.penetrations.filter_by(status='not_started').count()
-        open_count = project.penetrations.filter_by(status='open').count()
-        closed = project.penetrations.filter_by(status='closed').count()
-        verified = project.penetrations.filter_by(status='verified').count()
-        
-        # Count pens without photos (or with less than 2 photos)
-        from models import Photo
-        pens_with_insufficient_photos = db.session.query(Penetration.id).outerjoin(Photo).group_by(
-            Penetration.id
-        ).having(
-            func.count(Photo.id) < 2
-        ).filter(
+        # Photos per pen in this project, for the "fewer than 2 photos" check below
+        photo_counts = db.session.query(
+            Photo.penetration_id,
+            func.count(Photo.id).label('photos')
+        ).join(Penetration, Photo.penetration_id == Penetration.id).filter(
             Penetration.project_id == project_id,
-            Penetration.status.in_(['open', 'closed'])  # Only check active pens
-        ).count()
+            Photo.upload_status == 'uploaded'
+        ).group_by(Photo.penetration_id).subquery()
+        
+        # By deck: status counts and active pens short of photos in one grouped query;
+        # the overall figures are the sum of the deck rows
+        deck_stats = db.session.query(
+            Penetration.deck,
+            *status_count_columns(),
+            func.count(Penetration.id).filter(
+                Penetration.status.in_(['open', 'closed']),  # Only check active pens
+                func.coalesce(photo_counts.c.photos, 0) < 2
+            ).label('insufficient_photos')
+        ).outerjoin(
+            photo_counts, photo_counts.c.penetration_id == Penetration.id
+        ).filter(
+            Penetration.project_id == project_id
+        ).group_by(Penetration.deck).all()
+        
+        overall = dict.fromkeys(('total',) + STATUSES, 0)
+        pens_with_insufficient_photos = 0
+        deck_data = []
+        for stat in deck_stats:
+            for key in overall:
+                overall[key] += getattr(stat, key)
+            pens_with_insufficient_photos += stat.insufficient_photos
+            deck_data.append({
+                'deck': stat.deck,
+                'total': stat.total,
+                'not_started': stat.not_started,
+                'open': stat.open,
+                'closed': stat.closed,
+                'verified': stat.verified
+            })
         
        # By contractor - aggregate all statuses
         contractor_stats = db.session.query(
@@ -322,48 +375,15 @@ def get_project_dashboard(project_id):
                 'completion_rate': completion_rate
             })
         
-                
-        # By deck
-        deck_stats = db.session.query(
-            Penetration.deck,
-            Penetration.status,
-            func.count(Penetration.id).label('count')
-        ).filter(
-            Penetration.project_id == project_id
-        ).group_by(
-            Penetration.deck,
-            Penetration.status
-        ).all()
-        
-        # Organize deck data
-        deck_data = {}
-        for deck, status, count in deck_stats:
-            if deck not in deck_data:
-                deck_data[deck] = {
-                    'deck': deck,
-                    'total': 0,
-                    'not_started': 0,
-                    'open': 0,
-                    'closed': 0,
-                    'verified': 0
-                }
-            
-            deck_data[deck][status] = count
-            deck_data[deck]['total'] += count
-        
         return jsonify({
             'project': project.to_dict(),
             'overall': {
-                'total': total,
-                'not_started': not_started,
-                'open': open_count,
-                'closed': closed,
-                'verified': verified,
-                'completion_rate': round((verified / total * 100), 2) if total > 0 else 0,
+                **overall,
+                'completion_rate': round((overall['verified'] / overall['total'] * 100), 2) if overall['total'] > 0 else 0,
                 'pens_without_photos': pens_with_insufficient_photos
             },
             'by_contractor': contractor_data,
-            'by_deck': list(deck_data.values())
+            'by_deck': deck_data
         }), 200
                
     except Exception as e:  # ADD THIS
@@ -377,20 +397,20 @@ def get_project_dashboard(project_id):
 def generate_invite_code(project_id):
     """Generate or regenerate invite code for contractor registration"""
     try:
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
+        load_identity()
         
         # Only supervisors/admins can generate invite codes
-        if current_user.role not in ['supervisor', 'admin']:
+        if g.claims.get('role') not in ['supervisor', 'admin']:
             return jsonify({'error': 'Unauthorized'}), 403
         
-        project = Project.query.get(project_id)
+        project = db.session.get(Project, project_id)
         if not project:
             return jsonify({'error': 'Project not found'}), 404
         
         # Generate new invite code
         invite_code = project.generate_invite_code()
         db.session.commit()
+        bump_cache_version('projects')
         
         return jsonify({
             'message': 'Invite code generated successfully',
@@ -408,14 +428,13 @@ def generate_invite_code(project_id):
 def get_invite_code(project_id):
     """Get current invite code for a project"""
     try:
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
+        load_identity()
         
         # Only supervisors/admins can view invite codes
-        if current_user.role not in ['supervisor', 'admin']:
+        if g.claims.get('role') not in ['supervisor', 'admin']:
             return jsonify({'error': 'Unauthorized'}), 403
         
-        project = Project.query.get(project_id)
+        project = db.session.get(Project, project_id)
         if not project:
             return jsonify({'error': 'Project not found'}), 404
         
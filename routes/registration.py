@@ -1,8 +1,10 @@
-from flask import Blueprint, request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt_identity
+from flask import Blueprint, request, jsonify, g
+from flask_jwt_extended import jwt_required
 from datetime import datetime
 from app import db
-from models import Project, ContractorRegistration, Contractor, User, ContractorAccessToken
+from utils.cache import bump_cache_version
+from models import Project, ContractorRegistration, Contractor, ContractorAccessToken
+from utils.auth import load_identity
 
 registration_bp = Blueprint('registration', __name__)
 
@@ -82,10 +84,9 @@ def submit(invite_code):
 def get_pending_registrations():
     """Get pending registrations (supervisor or admin)"""
     try:
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
+        load_identity()
         
-        if current_user.role not in ['supervisor', 'admin']:
+        if g.claims.get('role') not in ['supervisor', 'admin']:
             return jsonify({'error': 'Unauthorized'}), 403
         
         project_id = request.args.get('project_id')
@@ -107,13 +108,13 @@ def get_pending_registrations():
 def approve_registration(registration_id):
     """Approve contractor registration and generate access token (supervisor or admin)"""
     try:
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
+        load_identity()
+        user_id = g.user_id
         
-        if current_user.role not in ['supervisor', 'admin']:
+        if g.claims.get('role') not in ['supervisor', 'admin']:
             return jsonify({'error': 'Unauthorized'}), 403
         
-        registration = ContractorRegistration.query.get(registration_id)
+        registration = db.session.get(ContractorRegistration, registration_id)
         if not registration:
             return jsonify({'error': 'Registration not found'}), 404
         
@@ -140,7 +141,7 @@ def approve_registration(registration_id):
             db.session.flush()  # Get contractor ID
         
         # Link contractor to project if not already linked
-        project = Project.query.get(registration.project_id)
+        project = db.session.get(Project, registration.project_id)
                 
         # Generate access token
         token = ContractorAccessToken(
@@ -158,6 +159,7 @@ def approve_registration(registration_id):
         registration.reviewed_by = user_id
         
         db.session.commit()
+        bump_cache_version('contractors')
         
         return jsonify({
             'message': 'Registration approved successfully',
@@ -174,13 +176,13 @@ def approve_registration(registration_id):
 def reject_registration(registration_id):
     """Reject contractor registration (supervisor or admin)"""
     try:
-        user_id = int(get_jwt_identity())
-        current_user = User.query.get(user_id)
+        load_identity()
+        user_id = g.user_id
         
-        if current_user.role not in ['supervisor', 'admin']:
+        if g.claims.get('role') not in ['supervisor', 'admin']:
             return jsonify({'error': 'Unauthorized'}), 403
         
-        registration = ContractorRegistration.query.get(registration_id)
+        registration = db.session.get(ContractorRegistration, registration_id)
         if not registration:
             return jsonify({'error': 'Registration not found'}), 404
         
@@ -1,9 +1,10 @@
 from flask import Blueprint, request, jsonify
 from datetime import datetime
+from sqlalchemy import insert
 from app import db
-from models import ContractorAccessToken, Penetration, PenActivity, Photo, Project, Contractor
-import os
-from werkzeug.utils import secure_filename
+from models import ContractorAccessToken, Penetration, PenActivity, Project, Contractor
+from utils.cache import bump_cache_version
+from services.uploads import save_penetration_photo, contractor_access_check
 
 report_bp = Blueprint('report', __name__)
 
@@ -24,7 +25,7 @@ def get_contractor_form(token):
         db.session.commit()
         
         # Get project and contractor info
-        project = Project.query.get(access_token.project_id)
+        project = db.session.get(Project, access_token.project_id)
         contractor = access_token.contractor
         
         # Get penetrations for this contractor
@@ -33,6 +34,8 @@ def get_contractor_form(token):
             contractor_id=access_token.contractor_id
         ).all()
         
+        photo_counts = Penetration.photo_counts([p.id for p in penetrations])
+        
         return jsonify({
             'project': {
                 'id': project.id,
@@ -44,7 +47,7 @@ def get_contractor_form(token):
                 'id': contractor.id,
                 'name': contractor.name
             },
-            'penetrations': [p.to_dict() for p in penetrations]
+            'penetrations': [p.to_dict(photo_count=photo_counts.get(p.id, 0)) for p in penetrations]
         }), 200
         
     except Exception as e:
@@ -92,6 +95,7 @@ def create_pen_via_token(token):
         
         db.session.add(pen)
         db.session.commit()
+        bump_cache_version('penetrations')
         
         return jsonify(pen.to_dict()), 201
         
@@ -120,8 +124,8 @@ def submit_contractor_report(token):
         if not data.get('action') or data['action'] not in ['open', 'close']:
             return jsonify({'error': 'Invalid action. Must be "open" or "close"'}), 400
         
-        # Find penetration by database ID (not pen_id string)
-        penetration = Penetration.query.get(data['pen_id'])
+        # Find penetration by database ID (not pen_id string), locked for the status change
+        penetration = db.session.get(Penetration, data['pen_id'], with_for_update=True)
         
         if not penetration:
             return jsonify({'error': 'Penetration not found'}), 404
@@ -133,7 +137,7 @@ def submit_contractor_report(token):
         # ========== ADD THIS VALIDATION BLOCK ==========
         # Validate photo count when closing
         if data['action'] == 'close':
-            photo_count = penetration.photos.count()
+            photo_count = Penetration.photo_count_upto(penetration.id, 2)
             if photo_count < 2:
                 return jsonify({
                     'error': f'Cannot close: Only {photo_count} photo(s) attached. Minimum 2 photos required.',
@@ -157,7 +161,7 @@ def submit_contractor_report(token):
         contractor = access_token.contractor
         activity_notes = data.get('notes', '')
         
-        activity = PenActivity(
+        activity = db.session.scalars(insert(PenActivity).returning(PenActivity), [dict(
             penetration_id=penetration.id,
             user_id=None,  # No user for magic link access
             action=data['action'],
@@ -165,14 +169,13 @@ def submit_contractor_report(token):
             new_status=penetration.status,
             notes=activity_notes,
             contractor_name=contractor.name  # Add contractor attribution
-        )
-        
-        db.session.add(activity)
+        )]).one()
         
         # Update last used timestamp
         access_token.last_used_at = datetime.utcnow()
         
         db.session.commit()
+        bump_cache_version('penetrations')
         
         return jsonify({
             'message': 'Report submitted successfully',
@@ -188,17 +191,6 @@ def submit_contractor_report(token):
 def upload_contractor_photo(token):
     """Upload photo for penetration via Cloudinary (public, no auth required)"""
     try:
-        import cloudinary
-        import cloudinary.uploader
-        
-        # Configure Cloudinary
-        cloudinary.config(
-            cloud_name=os.environ.get('CLOUDINARY_CLOUD_NAME'),
-            api_key=os.environ.get('CLOUDINARY_API_KEY'),
-            api_secret=os.environ.get('CLOUDINARY_API_SECRET'),
-            secure=True
-        )
-        
         access_token = ContractorAccessToken.query.filter_by(token=token).first()
         
         if not access_token:
@@ -207,62 +199,7 @@ def upload_contractor_photo(token):
         if not access_token.is_valid():
             return jsonify({'error': 'Access link has expired or been revoked'}), 403
         
-        if 'file' not in request.files:
-            return jsonify({'error': 'No file provided'}), 400
-        
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({'error': 'No file selected'}), 400
-        
-        # Validate file type
-        ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'heic'}
-        if not ('.' in file.filename and file.filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS):
-            return jsonify({'error': 'Invalid file type'}), 400
-        
-        penetration_id = request.form.get('penetration_id')
-        if not penetration_id:
-            return jsonify({'error': 'Penetration ID required'}), 400
-        
-        penetration = Penetration.query.get(penetration_id)
-        if not penetration:
-            return jsonify({'error': 'Penetration not found'}), 404
-        
-        if penetration.contractor_id != access_token.contractor_id:
-            return jsonify({'error': 'You are not assigned to this penetration'}), 403
-        
-        photo_type = request.form.get('photo_type', 'general')
-        caption = request.form.get('caption')
-        
-        # Upload to Cloudinary
-        upload_result = cloudinary.uploader.upload(
-            file,
-            folder=f"penlog/pen_{penetration_id}",
-            resource_type="image",
-            transformation=[
-                {'width': 1920, 'height': 1080, 'crop': 'limit'},
-                {'quality': 'auto:good'}
-            ]
-        )
-        
-        # Create photo record
-        photo = Photo(
-            penetration_id=penetration_id,
-            user_id=None,
-            filename=secure_filename(file.filename),
-            filepath=upload_result['secure_url'],  # Cloudinary URL
-            cloudinary_public_id=upload_result['public_id'],
-            caption=caption,
-            photo_type=photo_type
-        )
-        
-        db.session.add(photo)
-        access_token.last_used_at = datetime.utcnow()
-        db.session.commit()
-        
-        return jsonify({
-            'message': 'Photo uploaded successfully',
-            'photo': photo.to_dict()
-        }), 201
+        return save_penetration_photo(contractor_access_check(access_token))
         
     except Exception as e:
         db.session.rollback()
@@ -0,0 +1,5 @@
+"""Shared thread pool for long-running work (e.g. export jobs) kept off the request threads"""
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+
+executor = ThreadPoolExecutor(max_workers=Config.BACKGROUND_THREADS, thread_name_prefix='penlog-bg')
@@ -0,0 +1,86 @@
+"""Background export jobs: build a report on the shared thread pool and poll for it"""
+import os
+import socket
+import time
+import uuid
+from flask import current_app
+from sqlalchemy.orm import joinedload, selectinload
+from app import db, cache
+from models import Project, Penetration, Photo
+from services.background import executor
+
+# Finished files are kept for an hour. Job state lives in the cache, so jobs are
+# only offered with a cache every worker shares (REDIS_URL): with a per-process
+# cache a poll landing on another worker would 404.
+EXPORT_JOB_TIMEOUT = 60 * 60
+
+# The file itself stays in the WORK_FOLDER of the host that built it, so async
+# exports need a single host (one dyno/machine, any number of workers on it).
+# Jobs record their host and a download reaching any other host is refused.
+EXPORT_HOST = socket.gethostname()
+
+def export_jobs_available():
+    """Whether background export job state is visible to every worker"""
+    return current_app.config['CACHE_TYPE'] == 'RedisCache'
+
+def load_export_penetrations(project_id, with_photos=False):
+    """A project's penetrations with contractors (and optionally photos) loaded up front"""
+    options = [joinedload(Penetration.contractor)]
+    if with_photos:
+        # One-to-many: a second IN query rather than a join that repeats each pen per photo.
+        # Photos still uploading in the background have no URL to export yet.
+        options.append(selectinload(Penetration.photos.and_(Photo.upload_status == 'uploaded')))
+    
+    return Penetration.query.options(*options).filter_by(project_id=project_id).all()
+
+def _job_key(job_id):
+    return f'export_job:{job_id}'
+
+def export_job_path(job_id):
+    """Where a job's finished file is written (absolute: send_file resolves relative paths against the app root)"""
+    return os.path.abspath(os.path.join(current_app.config['WORK_FOLDER'], 'exports', f'{job_id}.xlsx'))
+
+def get_export_job(job_id):
+    """Current state of a job ({'status': ...}), or None if unknown/expired"""
+    return cache.get(_job_key(job_id))
+
+def export_job_is_local(job):
+    """Whether a job's file was written on this host"""
+    return job.get('host') == EXPORT_HOST
+
+def _prune_exports(folder):
+    """Delete finished files whose job state has expired"""
+    cutoff = time.time() - EXPORT_JOB_TIMEOUT
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+
+def start_complete_package_export(project_id, filename):
+    """Queue a complete package export and return its job id"""
+    job_id = uuid.uuid4().hex
+    cache.set(_job_key(job_id), {'status': 'queued', 'filename': filename, 'host': EXPORT_HOST}, timeout=EXPORT_JOB_TIMEOUT)
+    executor.submit(_run_complete_package_export, current_app._get_current_object(), job_id, project_id, filename)
+    return job_id
+
+def _run_complete_package_export(app, job_id, project_id, filename):
+    with app.app_context():
+        try:
+            from utils.package_generator import generate_complete_package
+            
+            project = db.session.get(Project, project_id)
+            penetrations = load_export_penetrations(project_id, with_photos=True)
+            
+            path = export_job_path(job_id)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _prune_exports(os.path.dirname(path))
+            with open(path, 'wb') as output:
+                generate_complete_package(project, penetrations, app.config['UPLOAD_FOLDER'], output=output)
+            
+            state = {'status': 'finished', 'filename': filename, 'host': EXPORT_HOST}
+        except Exception as e:
+            state = {'status': 'failed', 'filename': filename, 'host': EXPORT_HOST, 'error': str(e)}
+        finally:
+            db.session.remove()
+        
+        cache.set(_job_key(job_id), state, timeout=EXPORT_JOB_TIMEOUT)
@@ -0,0 +1,370 @@
+"""Photo uploads to Cloudinary"""
+import hashlib
+import os
+import re
+import shutil
+import time
+import uuid
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+import cloudinary
+import cloudinary.api
+import cloudinary.exceptions
+import cloudinary.uploader
+import cloudinary.utils
+from flask import current_app, jsonify, request, url_for
+from sqlalchemy import delete
+from werkzeug.datastructures import FileStorage
+from werkzeug.utils import secure_filename
+from app import db
+from config import Config
+from models import Penetration, Photo
+from utils.cache import bump_cache_version
+
+# Photos are sent in parts of this size (as upload_large() does), so a request holds
+# at most one part in memory instead of reading the whole (up to 16MB) upload at once
+UPLOAD_CHUNK_SIZE = 6_000_000
+
+# Cloudinary answers bursts with 429 / "Rate Limit Exceeded", and field LTE drops
+# connections mid-part; either way only the failed part is retried, a couple of
+# times with backoff, before the error reaches the client
+UPLOAD_RETRY_ATTEMPTS = 3
+UPLOAD_RETRY_MAX_WAIT = 30
+RATE_LIMIT_RE = re.compile(r'rate limit|quota', re.IGNORECASE)
+# How cloudinary.uploader.call_api reports socket and urllib3 transport failures
+TRANSPORT_ERROR_RE = re.compile(r'^(Socket error|Unexpected error)')
+
+# Cap on uploads in flight per process. Bursts beyond it wait up to
+# UPLOAD_SLOT_TIMEOUT seconds for a slot and are then refused with a 503, rather
+# than piling up in memory and tripping Cloudinary's rate limit. Sync uploads run
+# on gunicorn's request threads, so the limit must stay below GUNICORN_THREADS
+# (see gunicorn.conf.py) for the 503 to ever trigger; the default of half leaves
+# the other threads free for non-upload requests. Set in config.py, which sizes
+# the DB pool's overflow from it.
+UPLOAD_CONCURRENCY_LIMIT = Config.UPLOAD_CONCURRENCY_LIMIT
+UPLOAD_SLOT_TIMEOUT = 30
+UPLOAD_SEMAPHORE = BoundedSemaphore(UPLOAD_CONCURRENCY_LIMIT)
+
+_active_lock = Lock()
+_active_uploads = 0
+
+# Background (?async=true) uploads and asset deletes spend their time waiting on
+# Cloudinary, so they get their own pool rather than tying up services.background
+upload_executor = ThreadPoolExecutor(
+    max_workers=UPLOAD_CONCURRENCY_LIMIT,
+    thread_name_prefix='penlog-upload'
+)
+
+# Background uploads copy the request's file to WORK_FOLDER/staging in 1MB reads;
+# leftovers older than this (e.g. from a killed worker), and their 'pending' photos,
+# are pruned
+STAGING_COPY_BUFFER = 1024 * 1024
+STAGING_MAX_AGE = 60 * 60
+
+# cloudinary.api.delete_resources() accepts at most this many public ids per call
+DELETE_BATCH_SIZE = 100
+
+# Applied by Cloudinary on ingest: cap the size and let it pick the quality.
+# auto:eco runs its perceptual (MozJPEG-style) encoder at the smaller end, which
+# stores and serves noticeably fewer bytes with no visible loss for site photos.
+PHOTO_TRANSFORMATION = [
+    {'width': 1920, 'height': 1080, 'crop': 'limit'},  # Max size
+    {'quality': 'auto:eco'}  # Auto optimize quality
+]
+
+# Delivery-time options for redirects to a stored photo: serve WebP/AVIF to
+# clients that accept them (format can't be negotiated at upload)
+PHOTO_DELIVERY_OPTIONS = {'fetch_format': 'auto', 'secure': True}
+
+def photo_delivery_url(photo):
+    """Cloudinary URL for a Photo in the best format the client supports (stored URL as fallback)"""
+    if not photo.cloudinary_public_id or not cloudinary.config().cloud_name:
+        return photo.filepath
+    return cloudinary.utils.cloudinary_url(photo.cloudinary_public_id, **PHOTO_DELIVERY_OPTIONS)[0]
+
+def is_rate_limited(error):
+    """Whether a Cloudinary error is a transient 429 / rate limit / quota rejection"""
+    return (isinstance(error, cloudinary.exceptions.RateLimited) or
+            getattr(error, 'http_code', None) == 429 or
+            RATE_LIMIT_RE.search(str(error)) is not None)
+
+def is_transient(error):
+    """Whether retrying a failed upload part could succeed: rate limited or the connection failed"""
+    return is_rate_limited(error) or TRANSPORT_ERROR_RE.search(str(error)) is not None
+
+def _upload_part(part, http_headers, options):
+    """upload_large_part() with exponential backoff (1s, 2s, ... up to 30s) on transient errors"""
+    for attempt in range(UPLOAD_RETRY_ATTEMPTS):
+        try:
+            return cloudinary.uploader.upload_large_part(part, http_headers=http_headers, **options)
+        except cloudinary.exceptions.Error as e:
+            if attempt == UPLOAD_RETRY_ATTEMPTS - 1 or not is_transient(e):
+                raise
+            time.sleep(min(2 ** attempt, UPLOAD_RETRY_MAX_WAIT))
+
+def photo_content_hash(file):
+    """SHA-256 hex digest of an uploaded FileStorage's bytes, leaving its stream rewound"""
+    digest = hashlib.file_digest(file.stream, 'sha256').hexdigest()
+    file.stream.seek(0)
+    return digest
+
+def upload_penetration_photo(file, penetration_id):
+    """Stream an uploaded FileStorage to penlog/pen_<id> and return Cloudinary's result"""
+    # The upload_large() protocol, driven here so a rate-limited part is retried on
+    # its own. file.stream is Werkzeug's spooled temp file, read one part at a time.
+    stream = file.stream
+    size = cloudinary.utils.file_io_size(stream)
+    upload_id = cloudinary.utils.random_public_id()
+    options = {
+        'filename': file.filename,
+        'folder': f"penlog/pen_{penetration_id}",
+        'resource_type': "image",
+        'transformation': PHOTO_TRANSFORMATION
+    }
+    
+    result = None
+    offset = 0
+    for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b''):
+        http_headers = {
+            'Content-Range': f"bytes {offset}-{offset + len(chunk) - 1}/{size}",
+            'X-Unique-Upload-Id': upload_id
+        }
+        offset += len(chunk)
+        result = _upload_part((file.filename, chunk), http_headers, options)
+        options['public_id'] = result.get('public_id')
+    
+    return result
+
+def acquire_upload_slot():
+    """Take one of the UPLOAD_CONCURRENCY_LIMIT slots; False if none frees up within UPLOAD_SLOT_TIMEOUT"""
+    global _active_uploads
+    if not UPLOAD_SEMAPHORE.acquire(timeout=UPLOAD_SLOT_TIMEOUT):
+        return False
+    
+    with _active_lock:
+        _active_uploads += 1
+    return True
+
+def release_upload_slot():
+    """Give back a slot taken by acquire_upload_slot()"""
+    global _active_uploads
+    with _active_lock:
+        _active_uploads -= 1
+    UPLOAD_SEMAPHORE.release()
+
+class UploadSlotUnavailable(Exception):
+    """Every upload slot stayed busy for UPLOAD_SLOT_TIMEOUT seconds"""
+
+def upload_penetration_photo_in_slot(file, penetration_id):
+    """upload_penetration_photo() while holding an upload slot; raises UploadSlotUnavailable when saturated"""
+    if not acquire_upload_slot():
+        raise UploadSlotUnavailable()
+    
+    try:
+        return upload_penetration_photo(file, penetration_id)
+    finally:
+        release_upload_slot()
+
+def save_penetration_photo(check_penetration=None, user_id=None, queue=False):
+    """Handle a photo upload form for the upload endpoints; returns the view's response tuple
+
+    check_penetration(penetration) runs once the pen is found and before any upload
+    work, returning an error response to refuse it (or None to go ahead).
+    """
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file provided'}), 400
+    
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({'error': 'No file selected'}), 400
+    
+    if not Config.is_allowed(file.filename):
+        return jsonify({'error': 'Invalid file type. Allowed: png, jpg, jpeg, gif, heic'}), 400
+    
+    # An empty body would make no upload parts, and so no Cloudinary result
+    if cloudinary.utils.file_io_size(file.stream) == 0:
+        return jsonify({'error': 'File is empty'}), 400
+    
+    penetration_id = request.form.get('penetration_id', type=int)
+    if not penetration_id:
+        return jsonify({'error': 'Penetration ID required'}), 400
+    
+    # Check the pen (and the caller's access to it) before any Cloudinary work is spent on it
+    penetration = db.session.get(Penetration, penetration_id)
+    if not penetration:
+        return jsonify({'error': 'Penetration not found'}), 404
+    
+    if check_penetration:
+        refused = check_penetration(penetration)
+        if refused:
+            return refused
+    
+    # A re-upload of a file this pen already has gets the existing photo back
+    # instead of another Cloudinary upload
+    content_hash = photo_content_hash(file)
+    duplicate = Photo.query.filter_by(penetration_id=penetration_id, content_hash=content_hash).first()
+    if duplicate:
+        return jsonify({
+            'message': 'Photo already uploaded',
+            'photo': duplicate.to_dict()
+        }), 200
+    
+    photo = Photo(
+        penetration_id=penetration_id,
+        user_id=user_id,  # None for magic link uploads
+        filename=secure_filename(file.filename),
+        content_hash=content_hash,
+        caption=request.form.get('caption'),
+        photo_type=request.form.get('photo_type', 'general')
+    )
+    
+    # queue: answer 202 with a 'pending' photo and upload on the upload pool
+    if queue:
+        return _queue_photo_upload(file, photo)
+    
+    # Upload to Cloudinary (organized by penetration ID)
+    try:
+        upload_result = upload_penetration_photo_in_slot(file, penetration_id)
+    except UploadSlotUnavailable:
+        return jsonify({'error': 'Too many uploads in progress, please retry shortly'}), 503, {'Retry-After': str(UPLOAD_SLOT_TIMEOUT)}
+    
+    photo.filepath = upload_result['secure_url']  # Store Cloudinary URL
+    photo.cloudinary_public_id = upload_result['public_id']  # For deletion
+    
+    db.session.add(photo)
+    try:
+        db.session.commit()
+    except Exception:
+        # Nothing will ever point at the asset
+        cloudinary.uploader.destroy(upload_result['public_id'])
+        raise
+    bump_cache_version('penetrations')  # photo_count is part of penetration payloads
+    
+    return jsonify({
+        'message': 'Photo uploaded successfully',
+        'photo': photo.to_dict()
+    }), 201
+
+def _queue_photo_upload(file, photo):
+    """Stage an upload, save its 'pending' Photo and finish it on the upload pool"""
+    # Background uploads hold a slot like request-thread ones, so the limit (and
+    # /health) covers both and a sync upload never queues behind async jobs
+    if not acquire_upload_slot():
+        return jsonify({'error': 'Too many uploads in progress, please retry shortly'}), 503, {'Retry-After': str(UPLOAD_SLOT_TIMEOUT)}
+    
+    try:
+        # The request's temp file is gone after the response, so copy it out first
+        staged_path = stage_upload(file)
+        
+        photo.filepath = ''  # Cloudinary URL, filled in once uploaded
+        photo.upload_status = 'pending'
+        db.session.add(photo)
+        db.session.commit()
+        
+        start_staged_photo_upload(staged_path, photo.id, photo.penetration_id, file.filename)
+    except Exception:
+        release_upload_slot()
+        raise
+    
+    return jsonify({
+        'message': 'Photo upload queued',
+        'photo': photo.to_dict(),
+        'status_url': url_for('photos.get_photo_info', photo_id=photo.id)
+    }), 202
+
+def contractor_access_check(access_token):
+    """check_penetration for magic link uploads: the pen must be assigned to the link's contractor"""
+    def check(penetration):
+        if penetration.contractor_id != access_token.contractor_id:
+            return jsonify({'error': 'You are not assigned to this penetration'}), 403
+        
+        # Committed along with the photo
+        access_token.last_used_at = datetime.utcnow()
+        return None
+    
+    return check
+
+def upload_stats():
+    """Uploads in flight and the per-process limit, for /health"""
+    return {'active': _active_uploads, 'limit': UPLOAD_CONCURRENCY_LIMIT}
+
+def delete_cloudinary_photos(public_ids):
+    """Delete the Cloudinary assets of removed photos in the background, 100 per API call"""
+    public_ids = [public_id for public_id in public_ids if public_id]
+    if public_ids:
+        upload_executor.submit(_delete_resources, public_ids)
+
+def _delete_resources(public_ids):
+    for start in range(0, len(public_ids), DELETE_BATCH_SIZE):
+        try:
+            cloudinary.api.delete_resources(public_ids[start:start + DELETE_BATCH_SIZE])
+        except Exception as e:
+            # The database rows are already gone; an orphaned asset only costs storage
+            print(f"Cloudinary deletion error: {str(e)}")
+
+def staging_path(name):
+    """Where a staged upload is kept (absolute, like export files; never under the public UPLOAD_FOLDER)"""
+    return os.path.abspath(os.path.join(current_app.config['WORK_FOLDER'], 'staging', name))
+
+def stage_upload(file):
+    """Copy an uploaded FileStorage somewhere that outlives the request and return the path"""
+    path = staging_path(uuid.uuid4().hex)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as staged:
+        shutil.copyfileobj(file.stream, staged, STAGING_COPY_BUFFER)
+    return path
+
+def _prune_staging(folder):
+    """Delete staged files no job is going to pick up"""
+    cutoff = time.time() - STAGING_MAX_AGE
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+
+def start_staged_photo_upload(path, photo_id, penetration_id, filename):
+    """Upload a staged file on the upload pool and mark its pending Photo uploaded (releases the caller's slot)"""
+    upload_executor.submit(
+        _run_staged_upload, current_app._get_current_object(), path, photo_id, penetration_id, filename
+    )
+
+def _run_staged_upload(app, path, photo_id, penetration_id, filename):
+    with app.app_context():
+        try:
+            with open(path, 'rb') as stream:
+                result = upload_penetration_photo(FileStorage(stream, filename), penetration_id)
+            
+            photo = db.session.get(Photo, photo_id)
+            if photo:
+                photo.filepath = result['secure_url']
+                photo.cloudinary_public_id = result['public_id']
+                photo.upload_status = 'uploaded'
+            else:
+                # Deleted while it was uploading
+                cloudinary.uploader.destroy(result['public_id'])
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Photo upload error: {str(e)}")
+            # Drop the placeholder: clients polling /info get a 404 instead of 'pending' forever
+            db.session.execute(delete(Photo).where(Photo.id == photo_id, Photo.upload_status == 'pending'))
+            db.session.commit()
+        finally:
+            release_upload_slot()
+            os.remove(path)
+            _prune_staging(os.path.dirname(path))
+            _prune_pending_photos()
+            db.session.remove()
+        
+        bump_cache_version('penetrations')
+
+def _prune_pending_photos():
+    """Delete 'pending' photos whose upload job died with its worker (their staged file is pruned too)"""
+    cutoff = datetime.utcnow() - timedelta(seconds=STAGING_MAX_AGE)
+    try:
+        db.session.execute(delete(Photo).where(Photo.upload_status == 'pending', Photo.uploaded_at < cutoff))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Pending photo cleanup error: {str(e)}")
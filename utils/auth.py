@@ -0,0 +1,67 @@
+"""Authorization helpers backed by JWT claims"""
+from functools import wraps
+from flask import g, jsonify
+from flask_jwt_extended import get_jwt, get_jwt_identity
+from sqlalchemy import select
+from app import db
+from models import User
+
+def user_claims(user):
+    """Claims embedded in the access token so role checks don't need a DB lookup"""
+    return {
+        'role': user.role,
+        'username': user.username,
+        'contractor_id': user.contractor_id
+    }
+
+def current_claims():
+    """
+    Get role claims for the current request
+
+    Tokens issued before claims were added fall back to loading the user.
+    """
+    claims = get_jwt()
+    if 'role' in claims and 'contractor_id' in claims:
+        return claims
+
+    user = current_user_access()
+    return user_claims(user) if user else {}
+
+def load_user_access(user_id):
+    """Fetch only the User columns authorization checks read, as a lightweight row"""
+    return db.session.execute(
+        select(User.id, User.role, User.username, User.contractor_id).where(User.id == user_id)
+    ).one_or_none()
+
+def current_user_access():
+    """load_user_access() for the JWT identity, memoized on g for the rest of the request"""
+    if 'user_access' not in g:
+        g.user_access = load_user_access(int(get_jwt_identity()))
+    return g.user_access
+
+def load_identity():
+    """Store the caller's user id and claims on g for the rest of the request"""
+    g.user_id = int(get_jwt_identity())
+    g.claims = current_claims()
+
+def admin_required(fn):
+    """Restrict a view to the admin account (use below @jwt_required())"""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        load_identity()
+        if g.claims.get('username') != 'admin':
+            return jsonify({'error': 'Unauthorized'}), 403
+        return fn(*args, **kwargs)
+    return wrapper
+
+def role_required(*roles):
+    """Restrict a view to users whose role claim is in roles (use below @jwt_required())"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            load_identity()
+            if g.claims.get('role') not in roles:
+                return jsonify({'error': 'Unauthorized'}), 403
+            return fn(*args, **kwargs)
+        return wrapper
+    return decorator
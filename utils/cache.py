@@ -0,0 +1,16 @@
+"""Versioned cache namespaces so one write invalidates every cached variant"""
+from app import cache
+
+def cache_version(namespace):
+    """Current version of a namespace - include it in cache keys"""
+    return cache.get(f'{namespace}:version') or 0
+
+def bump_cache_version(namespace):
+    """Invalidate everything cached under a namespace"""
+    cache.set(f'{namespace}:version', cache_version(namespace) + 1, timeout=0)
+
+def cacheable_response(rv):
+    """response_filter for cache.cached: only keep 200s, never error tuples"""
+    if isinstance(rv, tuple):
+        return rv[1] == 200
+    return getattr(rv, 'status_code', 200) == 200
@@ -5,16 +5,17 @@ from openpyxl.utils import get_column_letter
 from datetime import datetime
 from io import BytesIO
 
-def generate_penetration_excel(project, penetrations):
+def generate_penetration_excel(project, penetrations, output=None):
     """
     Generate an Excel workbook for penetration tracking
     
     Args:
         project: Project object
         penetrations: List of Penetration objects
+        output: Binary file object to write into (defaults to a new BytesIO)
     
     Returns:
-        BytesIO object containing the Excel file
+        The output file object, rewound to the start
     """
     wb = Workbook()
     
@@ -291,8 +292,8 @@ def generate_penetration_excel(project, penetrations):
     
     ws_decks.freeze_panes = 'A2'
     
-    # Save to BytesIO
-    buffer = BytesIO()
+    # Save to the caller's file (BytesIO by default)
+    buffer = output if output is not None else BytesIO()
     wb.save(buffer)
     buffer.seek(0)
     return buffer
\ No newline at end of file
@@ -5,7 +5,7 @@ from openpyxl.utils import get_column_letter
 from datetime import datetime
 from io import BytesIO
 
-def generate_complete_package(project, penetrations, upload_folder):
+def generate_complete_package(project, penetrations, upload_folder, output=None):
     """
     Generate complete package: Excel with Cloudinary photo links
     
@@ -13,9 +13,10 @@ def generate_complete_package(project, penetrations, upload_folder):
         project: Project object
         penetrations: List of Penetration objects
         upload_folder: Not used (kept for backward compatibility)
+        output: Binary file object to write into (defaults to a new BytesIO)
     
     Returns:
-        BytesIO object containing the Excel file
+        The output file object, rewound to the start
     """
     
     # === CREATE EXCEL FILE ===
@@ -74,9 +75,8 @@ def generate_complete_package(project, penetrations, upload_folder):
             status_cell.fill = PatternFill(start_color="fee2e2", end_color="fee2e2", fill_type="solid")
             status_cell.font = Font(color="991b1b", bold=True)
         
-        # Get photos for this pen
-        from models import Photo
-        photos = Photo.query.filter_by(penetration_id=pen.id).order_by(Photo.uploaded_at).all()
+        # Get photos for this pen, oldest first (callers preload pen.photos)
+        photos = sorted(pen.photos, key=lambda photo: photo.uploaded_at)
         
         opening_photo_url = None
         closing_photo_url = None
@@ -196,8 +196,8 @@ def generate_complete_package(project, penetrations, upload_folder):
     ws_instructions.column_dimensions['A'].width = 40
     ws_instructions.column_dimensions['B'].width = 40
     
-    # Save Excel file to buffer
-    excel_buffer = BytesIO()
+    # Save Excel file to the caller's file (BytesIO by default)
+    excel_buffer = output if output is not None else BytesIO()
     wb.save(excel_buffer)
     excel_buffer.seek(0)
     
@@ -9,9 +9,8 @@ from reportlab.lib.enums import TA_CENTER, TA_RIGHT, TA_LEFT
 from datetime import datetime
 from io import BytesIO
 import os
-from PIL import Image as PILImage
 
-def generate_penetration_report(project, penetrations, include_photos=True):
+def generate_penetration_report(project, penetrations, include_photos=True, output=None):
     """
     Generate a PDF report for penetration tracking
     
@@ -19,11 +18,12 @@ def generate_penetration_report(project, penetrations, include_photos=True):
         project: Project object
         penetrations: List of Penetration objects
         include_photos: Boolean to include photo evidence section
+        output: Binary file object to write into (defaults to a new BytesIO)
     
     Returns:
-        BytesIO object containing the PDF
+        The output file object, rewound to the start
     """
-    buffer = BytesIO()
+    buffer = output if output is not None else BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=A4, 
                            rightMargin=0.75*inch, leftMargin=0.75*inch,
                            topMargin=1*inch, bottomMargin=1*inch)
@@ -109,14 +109,7 @@ def generate_penetration_report(project, penetrations, include_photos=True):
         if pen.deck:
             decks.add(pen.deck)
         # Count photos
-        if hasattr(pen, 'photos'):
-            # Handle both list and dynamic query
-            if hasattr(pen.photos, 'count'):
-                # It's a dynamic query
-                total_photos += pen.photos.count()
-            else:
-                # It's a list
-                total_photos += len(pen.photos)
+        total_photos += len(pen.photos)
     
     completion_rate = ((status_counts['closed'] + status_counts['verified']) / total * 100) if total > 0 else 0
     
@@ -186,14 +179,7 @@ def generate_penetration_report(project, penetrations, include_photos=True):
             'verified': 'Verified'
         }.get(pen.status, pen.status)
         
-        # Handle both list and dynamic query for photo count
-        if hasattr(pen, 'photos'):
-            if hasattr(pen.photos, 'count'):
-                photo_count = pen.photos.count()
-            else:
-                photo_count = len(pen.photos)
-        else:
-            photo_count = 0
+        photo_count = len(pen.photos)
         
         pen_data.append([
             pen.pen_id or '',
@@ -261,9 +247,9 @@ def generate_penetration_report(project, penetrations, include_photos=True):
     buffer.seek(0)
     return buffer
 
-def generate_contractor_report(project, contractor, penetrations):
-    """Generate a contractor-specific report"""
-    buffer = BytesIO()
+def generate_contractor_report(project, contractor, penetrations, output=None):
+    """Generate a contractor-specific report into output (defaults to a new BytesIO)"""
+    buffer = output if output is not None else BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=A4,
                            rightMargin=0.75*inch, leftMargin=0.75*inch,
                            topMargin=1*inch, bottomMargin=1*inch)
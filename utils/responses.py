@@ -0,0 +1,62 @@
+"""JSON response helpers for large list endpoints"""
+import re
+import orjson
+from functools import wraps
+from flask import current_app, request
+from flask.json.provider import DefaultJSONProvider
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson (dates, decimals etc. still encode as Flask does)"""
+    # Hand datetimes to Flask's default (HTTP dates) and accept non-str dict keys like json does
+    option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.option).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        """Like jsonify(), but hands orjson's bytes straight to the response"""
+        obj = self._prepare_response_obj(args, kwargs)
+        option = self.option | orjson.OPT_APPEND_NEWLINE
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            option |= orjson.OPT_INDENT_2
+        
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=option),
+            mimetype=self.mimetype
+        )
+
+def json_response(data, status=200):
+    """Serialize with orjson, which is several times faster than jsonify for big lists"""
+    return current_app.response_class(
+        orjson.dumps(data),
+        status=status,
+        mimetype='application/json'
+    )
+
+def json_array_response(items, serialize, status=200):
+    """Encode a JSON array one item at a time, so only one serialized dict is alive at once"""
+    body = b'[' + b','.join(orjson.dumps(serialize(item)) for item in items) + b']'
+    return current_app.response_class(body, status=status, mimetype='application/json')
+
+# Flask-Compress tags the ETag of a compressed response as "<etag>:br"
+ENCODING_ETAG_SUFFIX_RE = re.compile(r':(br|gzip|deflate|zstd)"')
+
+def _uncompressed_etag_environ(environ):
+    """WSGI environ whose If-None-Match carries the ETags as the view generated them"""
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if not if_none_match:
+        return environ
+    return {**environ, 'HTTP_IF_NONE_MATCH': ENCODING_ETAG_SUFFIX_RE.sub('"', if_none_match)}
+
+def conditional(fn):
+    """Answer If-None-Match with 304 Not Modified when a 200 response's ETag matches"""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        response = current_app.make_response(fn(*args, **kwargs))
+        if response.status_code == 200:
+            response.make_conditional(_uncompressed_etag_environ(request.environ))
+        return response
+    return wrapper